@@ -0,0 +1,738 @@
+#!/usr/bin/env python
+#
+# doxybench.py
+#
+# Copyright (c) 2014-2020, Bill Zissimopoulos. All rights reserved.
+#
+# This file is part of Doxyfmt.
+#
+# It is licensed under the MIT license. The full license text can be found
+# in the License.txt file at the root of this project.
+
+# # doxybench(1)
+# ==============
+#
+# NAME
+# ----
+# doxybench - benchmark doxyfmt over generated doxygen xml
+#
+# SYNOPSIS
+# --------
+# doxybench gen [OPTIONS] dir
+# doxybench BENCHMARK [OPTIONS] [--save FILE] [--baseline FILE]
+#
+# DESCRIPTION
+# -----------
+# The *doxybench* utility generates synthetic doxygen xml trees that resemble
+# the output of *doxygen* over a C API (files with functions, typedefs, enums,
+# macros, variables and typedef'd structs/unions) and times *doxyfmt* over
+# them. No *doxygen* install is required.
+#
+# BENCHMARKS
+# ----------
+# accessors
+#     Time the element accessor lookups that rendering performs per member.
+#
+# backends
+#     Time parsing every compound with each parser backend and report the
+#     memory that the parsed compounds retain. The ir image is compiled before
+#     timing starts.
+#
+# imports
+#     Time imports against a long sys.path (-P entries) without the pytempl
+#     import hook, with a hook that stats every path entry (as the hook once
+#     did) and with the pytempl hook. The hook is only consulted for modules
+#     that no other finder finds, so both missing modules (as probed for
+#     optional dependencies) and present ones are timed.
+#
+# maptext
+#     Time mapping the text of every detaileddescription with the markdown
+#     format's maps, using itermaptext, element.Maptext and the format's
+#     compiled mapper, and check that the output is identical.
+#
+# refresh
+#     Time a warm rebuild with each parser backend, as in watch mode: touch the
+#     xml of one file compound, re-read the index with the parser's refresh
+#     and update the symbols table. Exit with status 2 if the ir backend loses
+#     its image on refresh.
+#
+# render
+#     Time rendering of every file compound with the markdown template and
+#     report the per-member cost.
+#
+# stages
+#     Time each stage of a doxyfmt run separately: index load, compound
+#     parse, symbols table, render (to strings) and write; report throughput
+#     (MB/s of xml parsed or output written, members/s rendered) and the peak
+#     memory of a single untimed pass over all stages.
+#
+# startup
+#     Time the import overhead of doxyfmt.py --help and of a no-op run (one
+#     that finds all output up to date) with -X importtime, over that of a bare
+#     interpreter (-c pass), whose imports doxyfmt does not control. Exit with
+#     status 2 if --help imports any of the modules that only runs need, or if
+#     either overhead exceeds its import budget (--budget-help and
+#     --budget-run, in milliseconds).
+#
+# template
+#     Time rendering with the template translated with and without the
+#     pytempl optimizer and check that the output is identical.
+#
+# BASELINES
+# ---------
+# Every benchmark reports its results as metrics where lower is better
+# (seconds or MB). --save writes them to a JSON file together with the
+# corpus parameters; --baseline compares them with a saved file and exits
+# with status 2 if any metric exceeds its baseline by more than the
+# tolerance (-T, default 10%).
+
+import argparse, gc, importlib, io, json, os, random, subprocess, sys, tempfile, time, tracemalloc
+from xml.sax.saxutils import escape, quoteattr
+
+sys.dont_write_bytecode = True
+import pytempl
+import doxylib
+
+progdir = os.path.dirname(os.path.abspath(__file__))
+
+def warn(s):
+    print("%s: %s" % (os.path.basename(sys.argv[0]), s), file=sys.stderr)
+def fail(s, exitcode = 1):
+    warn(s)
+    sys.exit(exitcode)
+
+# begin corpus generator
+words = ["the", "value", "of", "a_b", "*ptr*", "[x](y)", "list", "`code`",
+    "foo", "bar", "-", "#", "1.", ">", "handle", "buffer", "size_t", "NULL"]
+
+class generator:
+    def __init__(self, files=100, structs=3, members=20, depth=2, typedefs=0.7, seed=1):
+        self.files = files
+        self.structs = structs
+        self.members = members
+        self.depth = depth
+        self.typedefs = typedefs
+        self.rnd = random.Random(seed)
+        self.nmembers = 0
+
+    def text(self, lo, hi):
+        rnd = self.rnd
+        return escape(" ".join(rnd.choice(words) for _ in range(rnd.randint(lo, hi))))
+
+    def para(self, depth):
+        rnd = self.rnd
+        s = "<para>" + self.text(3, 12)
+        if rnd.random() < 0.3:
+            s += " <computeroutput>call_me()</computeroutput> tail"
+        if rnd.random() < 0.2:
+            s += " <bold>bold</bold> <emphasis>em_ph</emphasis>"
+        if rnd.random() < 0.1:
+            s += ' see <ulink url="http://example.com/a%20b">link</ulink>.'
+        if 0 < depth and rnd.random() < 0.3:
+            s += "<itemizedlist>" + "".join("<listitem>" + self.para(depth - 1) + "</listitem>"
+                for _ in range(rnd.randint(1, 3))) + "</itemizedlist>"
+        return s + "</para>\n"
+
+    def brief(self):
+        if self.rnd.random() < 0.2:
+            return "<briefdescription>\n</briefdescription>"
+        return "<briefdescription>%s</briefdescription>" % self.para(0)
+
+    def detailed(self, params=(), ret=False):
+        s = "".join(self.para(self.depth) for _ in range(self.rnd.randint(0, 2)))
+        if params:
+            s += '<para><parameterlist kind="param">'
+            for p in params:
+                s += "<parameteritem><parameternamelist><parametername>%s</parametername>" \
+                    "</parameternamelist><parameterdescription>%s</parameterdescription>" \
+                    "</parameteritem>" % (p, self.para(self.depth))
+            s += "</parameterlist>"
+            if ret:
+                s += '<simplesect kind="return">%s</simplesect>' % self.para(self.depth)
+            s += "</para>"
+        return "<detaileddescription>%s</detaileddescription>" % s
+
+    def location(self, file, line, column=1):
+        return '<location file=%s line="%d" column="%d"/>' % (quoteattr(file), line, column)
+
+    def struct(self, f, s, file, inner):
+        kind = "union" if 2 == s % 3 else "struct"
+        id = "%s_s%d__%d" % (kind, f, s)
+        name = "s%d_%d" % (f, s)
+        fields = []
+        for m in range(self.rnd.randint(1, 4)):
+            self.nmembers += 1
+            fields.append('<memberdef kind="variable" id="%s_1a%d" prot="public" static="no">'
+                "<type>int</type><definition>int %s::f%d</definition><argsstring></argsstring>"
+                "<name>f%d</name>%s%s%s</memberdef>" % (id, m, name, m, m,
+                self.brief(), self.detailed(), self.location(file, 10 + s * 20 + m, 9)))
+        body = '<compounddef id="%s" kind="%s" language="C++" prot="public">' \
+            "<compoundname>%s</compoundname>%s" \
+            '<sectiondef kind="public-attrib">%s</sectiondef>%s%s%s</compounddef>' % (
+            id, kind, name, "".join('<innerclass refid="%s" prot="public">%s</innerclass>' % i
+                for i in inner), "".join(fields), self.brief(), self.detailed(),
+            self.location(file, 10 + s * 20))
+        return id, kind, name, body
+
+    def member(self, f, m, file, line, structs):
+        rnd = self.rnd
+        kind = ["function", "typedef", "enum", "define", "variable"][m % 5]
+        id = "api__%d_8h_1a%d" % (f, m)
+        name = "api%d_%s_%d" % (f, kind, m)
+        loc = self.location(file, line, rnd.randint(1, 20))
+        self.nmembers += 1
+        if "function" == kind:
+            params = ["arg_%d" % i for i in range(rnd.randint(0, 3))]
+            return "func", kind, name, '<memberdef kind="function" id="%s" prot="public" static="no">' \
+                "<type>int</type><definition>int %s</definition><argsstring>(%s)</argsstring>" \
+                "<name>%s</name>%s%s%s%s</memberdef>" % (id, name,
+                ", ".join("int " + p for p in params), name,
+                "".join("<param><type>int</type><declname>%s</declname></param>" % p for p in params),
+                self.brief(), self.detailed(params, rnd.random() < 0.7), loc)
+        elif "typedef" == kind:
+            if structs and rnd.random() < self.typedefs:
+                sid, sname = rnd.choice(structs)
+                type = 'struct <ref refid="%s" kindref="compound">%s</ref>' % (sid, sname)
+                definition = "typedef struct %s %s" % (sname, name)
+            else:
+                type = "unsigned"
+                definition = "typedef unsigned %s" % name
+            return "typedef", kind, name, '<memberdef kind="typedef" id="%s" prot="public" static="no">' \
+                "<type>%s</type><definition>%s</definition><argsstring></argsstring>" \
+                "<name>%s</name>%s%s%s</memberdef>" % (id, type, definition, name,
+                self.brief(), self.detailed(), loc)
+        elif "enum" == kind:
+            values = "".join('<enumvalue id="%s_1e%d" prot="public"><name>%s_V%d</name>'
+                "<initializer>= %d</initializer>%s<detaileddescription></detaileddescription>"
+                "</enumvalue>" % (id, i, name.upper(), i, i,
+                self.brief() if rnd.random() < 0.5 else "<briefdescription></briefdescription>")
+                for i in range(rnd.randint(1, 4)))
+            return "enum", kind, name, '<memberdef kind="enum" id="%s" prot="public" static="no">' \
+                "<type></type><name>%s</name>%s%s%s%s</memberdef>" % (id, name, values,
+                self.brief(), self.detailed(), loc)
+        elif "define" == kind:
+            params = "<param><defname>x</defname></param><param><defname>y_z</defname></param>" \
+                if rnd.random() < 0.5 else ""
+            return "define", kind, name.upper(), '<memberdef kind="define" id="%s" prot="public" static="no">' \
+                "<name>%s</name>%s<initializer>42</initializer>%s%s%s</memberdef>" % (id,
+                name.upper(), params, self.brief(), self.detailed(), loc)
+        else:
+            return "var", kind, name, '<memberdef kind="variable" id="%s" prot="public" static="no">' \
+                "<type>int</type><definition>int %s</definition><argsstring></argsstring>" \
+                "<name>%s</name>%s%s%s</memberdef>" % (id, name, name,
+                self.brief(), self.detailed(), loc)
+
+    def write(self, outdir):
+        def save(id, body):
+            with open(os.path.join(outdir, id + ".xml"), "w") as file:
+                file.write("<?xml version='1.0' encoding='UTF-8' standalone='no'?>\n"
+                    '<doxygen version="1.9.1" xml:lang="en-US">\n%s\n</doxygen>\n' % body)
+        os.makedirs(outdir, exist_ok=True)
+        index = []
+        for f in range(self.files):
+            file = "inc/mod%d/api_%d.h" % (f % 4, f)
+            fid = "api__%d_8h" % f
+            structs = []
+            for s in range(self.structs):
+                id, kind, name, body = self.struct(f, s, file, [])
+                structs.append((id, name, kind, body))
+            inner = []
+            for i, (id, name, kind, body) in enumerate(structs):
+                # every third struct nests the one after it
+                if i + 1 < len(structs) and 0 == i % 3:
+                    nid, nname = structs[i + 1][:2]
+                    body = body.replace("</compoundname>",
+                        '</compoundname><innerclass refid="%s" prot="public">%s</innerclass>' %
+                        (nid, nname), 1)
+                elif not (i and 1 == i % 3):
+                    inner.append((id, name))
+                save(id, body)
+                index.append('<compound refid="%s" kind="%s"><name>%s</name></compound>' %
+                    (id, kind, name))
+            sections = {}
+            members = []
+            line = 200
+            for m in range(self.members):
+                line = max(1, line + self.rnd.randint(-40, 40))
+                sect, kind, name, body = self.member(f, m, file, line,
+                    [s[:2] for s in structs])
+                sections.setdefault(sect, []).append(body)
+                members.append('<member refid="api__%d_8h_1a%d" kind="%s"><name>%s</name></member>' %
+                    (f, m, kind, name))
+            copy = '<para><simplesect kind="copyright"><para>2020 Example &amp; Co.</para>' \
+                "</simplesect></para>" if 0 == f % 2 else ""
+            save(fid, '<compounddef id="%s" kind="file" language="C++">'
+                "<compoundname>api_%d.h</compoundname>%s%s%s"
+                "<detaileddescription>%s%s</detaileddescription>%s</compounddef>" % (fid, f,
+                "".join('<innerclass refid="%s" prot="public">%s</innerclass>' % i for i in inner),
+                "".join('<sectiondef kind="%s">%s</sectiondef>' % (k, "".join(v))
+                    for k, v in sections.items()),
+                self.brief(), self.para(self.depth), copy, self.location(file, 1)))
+            index.append('<compound refid="%s" kind="file"><name>api_%d.h</name>%s</compound>' %
+                (fid, f, "".join(members)))
+        with open(os.path.join(outdir, "index.xml"), "w") as file:
+            file.write("<?xml version='1.0' encoding='UTF-8' standalone='no'?>\n"
+                '<doxygenindex version="1.9.1" xml:lang="en-US">\n%s\n</doxygenindex>\n' %
+                "\n".join(index))
+        return self.nmembers
+# end corpus generator
+
+def corpus(args, tmpdir):
+    if args.xml:
+        return os.path.join(args.xml, "index.xml"), None
+    xdir = os.path.join(tmpdir, "xml")
+    nmembers = generator(args.files, args.structs, args.members, args.depth,
+        args.typedefs, args.seed).write(xdir)
+    return os.path.join(xdir, "index.xml"), nmembers
+
+def render(template, path, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    index = doxylib.parser(path, 0).index
+    for f in os.listdir(outdir):
+        os.remove(os.path.join(outdir, f))
+    t = time.perf_counter()
+    template.main({ "outdir": outdir }, index)
+    return time.perf_counter() - t
+
+def bench_render(args, tmpdir):
+    path, nmembers = corpus(args, tmpdir)
+    template = pytempl.template_load(args.template)
+    best = min(render(template, path, os.path.join(tmpdir, "out")) for _ in range(args.repeat))
+    print("render: %.3fs" % best)
+    if nmembers:
+        print("render: %.1fus/member (%d members)" % (best * 1e6 / nmembers, nmembers))
+    return { "render": best }
+
+def bench_template(args, tmpdir):
+    path, nmembers = corpus(args, tmpdir)
+    templates = [pytempl.template_load(args.template, optimize=o) for o in [False, True]]
+    best = [None, None]
+    for r in range(args.repeat):
+        # alternate the order, so that neither variant benefits from running first
+        for o in [r % 2, 1 - r % 2]:
+            t = render(templates[o], path, os.path.join(tmpdir, "out%d" % o))
+            best[o] = t if best[o] is None else min(best[o], t)
+    for o in [False, True]:
+        print("template: optimize=%d %.3fs" % (o, best[o]))
+    output = []
+    for o in [0, 1]:
+        outdir = os.path.join(tmpdir, "out%d" % o)
+        out = {}
+        for f in sorted(os.listdir(outdir)):
+            with open(os.path.join(outdir, f), "rb") as file:
+                out[f] = file.read()
+        output.append(out)
+    if output[0] != output[1]:
+        fail("optimized template output differs")
+    return { "optimize=0": best[0], "optimize=1": best[1] }
+
+def member_lookups(e):
+    # the lookups that format.sectiondef/memberdef and the markdown template
+    # perform for a member, including the repeated ones
+    e.locationE.fileA, e.locationE.lineA, e.locationE.columnA
+    e.N; e.kindA; e.kindA; e.kindA
+    e.kindA; e.nameS; e.briefdescriptionE.T; e.briefdescriptionE.T
+    e.definitionT; e.argsstringT; e.paramE; e.paramE
+    d = e.detaileddescriptionE
+    d.T; d[".//parameterlistE"].T; d[".//simplesect[@kind='return']E"].T
+    e.N; e.kindA; e.kindA
+
+def bench_accessors(args, tmpdir):
+    path, _ = corpus(args, tmpdir)
+    p = doxylib.parser(path, 0)
+    comps = [c.element() for c in p.index.values()]
+    best = None
+    for _ in range(args.repeat):
+        members = [e for c in comps for s in doxylib.element(c.XMLElement).sectiondefL
+            for e in s.memberdefL]
+        n = len(members)
+        gc.collect()
+        gc.disable()
+        t = time.perf_counter()
+        for e in members:
+            member_lookups(e)
+        t = time.perf_counter() - t
+        gc.enable()
+        del members
+        best = t if best is None else min(best, t)
+    print("accessors: %.3fs" % best)
+    print("accessors: %.2fus/member (%d members)" % (best * 1e6 / n, n))
+    return { "accessors": best }
+
+def bench_maptext(args, tmpdir):
+    path, _ = corpus(args, tmpdir)
+    p = doxylib.parser(path, 0)
+    descs = [e for c in p.index.values()
+        for e in c.element().XMLElement.iter("detaileddescription")]
+    fmt = pytempl.template_load(args.template).markdown({ "outdir": tmpdir, "fileext": "" }, p.index)
+    fmt.reset(io.StringIO())
+    variants = [
+        ("itermaptext", lambda e: "".join(doxylib.itermaptext(e, fmt.escape, fmt.textmap, fmt.tailmap,
+            fmt.description_filter))),
+        ("Maptext", lambda e: doxylib.element(e).Maptext(fmt.escape, fmt.textmap, fmt.tailmap,
+            fmt.description_filter)),
+        ("mapper", lambda e: fmt.maptext(doxylib.element(e), fmt.description_filter)),
+    ]
+    best = [None] * len(variants)
+    output = [None] * len(variants)
+    for r in range(args.repeat):
+        for k in range(len(variants)):
+            v = (r + k) % len(variants)
+            gc.collect()
+            t = time.perf_counter()
+            output[v] = [variants[v][1](e) for e in descs]
+            t = time.perf_counter() - t
+            best[v] = t if best[v] is None else min(best[v], t)
+    for (name, _), t in zip(variants, best):
+        print("maptext: %-11s %.3fs (%d descriptions)" % (name, t, len(descs)))
+    for (name, _), o in zip(variants[1:], output[1:]):
+        if output[0] != o:
+            fail("%s output differs" % name)
+    return { name: t for (name, _), t in zip(variants, best) }
+
+def bench_backends(args, tmpdir):
+    path, _ = corpus(args, tmpdir)
+    results = {}
+    for backend in doxylib.parser.backends:
+        p = doxylib.parser(path, 0, backend)
+        ids = list(p.index)
+        best = None
+        for _ in range(args.repeat):
+            gc.collect()
+            t = time.perf_counter()
+            trees = [p.parse_compound(id) for id in ids]
+            t = time.perf_counter() - t
+            del trees
+            best = t if best is None else min(best, t)
+        gc.collect()
+        tracemalloc.start()
+        trees = [p.parse_compound(id) for id in ids]
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del trees
+        print("backends: %-6s parse %.3fs, memory %.1fMB (peak %.1fMB, %d compounds)" %
+            (backend, best, size / 1e6, peak / 1e6, len(ids)))
+        results[backend + ".parse"] = best
+        results[backend + ".memory"] = size / 1e6
+    return results
+
+def bench_refresh(args, tmpdir):
+    import shutil
+    path, _ = corpus(args, tmpdir)
+    results = {}
+    for backend in doxylib.parser.backends:
+        xdir = os.path.join(tmpdir, "refresh-" + backend)
+        shutil.copytree(os.path.dirname(path), xdir)
+        p = doxylib.parser(os.path.join(xdir, "index.xml"), 0, backend)
+        p.symbols()
+        for c in p.index.values():
+            c.digest()
+        files = [i for i in p.index if "file" == p.index[i].cref.kindA]
+        best = None
+        for k in range(args.repeat):
+            with open(p.compound_path(files[k % len(files)]), "a") as file:
+                file.write("\n")
+            t = time.perf_counter()
+            changed = p.refresh()
+            p.symbols()
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+            if "ir" == backend and p.image is None:
+                fail("refresh dropped the ir image", 2)
+        print("refresh: %-6s %.3fs (%d changed of %d compounds)" % (backend, best, len(changed),
+            len(p.index)))
+        results[backend + ".refresh"] = best
+        if p.image is not None:
+            p.image.close()
+    return results
+
+def format_class(template):
+    for v in vars(template).values():
+        if isinstance(v, type) and issubclass(v, doxylib.format) and v is not doxylib.format:
+            return v
+    fail("%s: no format class" % template.__file__)
+
+def bench_stages(args, tmpdir):
+    path, nmembers = corpus(args, tmpdir)
+    cls = format_class(pytempl.template_load(args.template))
+    outdir = os.path.join(tmpdir, "out")
+    os.makedirs(outdir, exist_ok=True)
+    backend = args.backend
+    if "ir" == backend:
+        doxylib.parser(path, 0, backend)
+    def stages():
+        # run every stage once; returns the stage times and what was processed
+        times = {}
+        t = time.perf_counter()
+        p = doxylib.parser(path, 0, backend)
+        times["index"] = time.perf_counter() - t
+        ids = list(p.index)
+        t = time.perf_counter()
+        for id in ids:
+            p.compound_element(id)
+        times["parse"] = time.perf_counter() - t
+        t = time.perf_counter()
+        p.symbols()
+        times["symbols"] = time.perf_counter() - t
+        fmt = cls({ "outdir": outdir, "fileext": ".md" }, p.index)
+        files = [i for i in ids if "file" == p.index[i].cref.kindA]
+        t = time.perf_counter()
+        texts = [fmt.render_string(i) for i in files]
+        times["render"] = time.perf_counter() - t
+        t = time.perf_counter()
+        for i, text in zip(files, texts):
+            with open(os.path.join(outdir, i + fmt.fileext), "w", newline="\n") as file:
+                file.write(text)
+        times["write"] = time.perf_counter() - t
+        return times, p, texts
+    best = {}
+    for _ in range(args.repeat):
+        gc.collect()
+        times, p, texts = stages()
+        for k, v in times.items():
+            best[k] = min(best.get(k, v), v)
+        del p
+    # untimed pass for peak memory; tracemalloc slows everything down
+    del texts
+    gc.collect()
+    tracemalloc.start()
+    times, p, texts = stages()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ids = list(p.index)
+    xmlsize = sum(os.path.getsize(p.compound_path(id)) for id in ids)
+    outsize = sum(len(text.encode("utf-8")) for text in texts)
+    if not nmembers:
+        nmembers = sum(1 for id in ids for _ in p.compound_element(id).XMLElement.iter("memberdef"))
+    print("stages: index   %.3fs (%d compounds)" % (best["index"], len(ids)))
+    print("stages: parse   %.3fs (%.1fMB/s of xml, %s backend)" %
+        (best["parse"], xmlsize / 1e6 / best["parse"], backend))
+    print("stages: symbols %.3fs" % best["symbols"])
+    print("stages: render  %.3fs (%d members/s)" % (best["render"], nmembers / best["render"]))
+    print("stages: write   %.3fs (%.1fMB/s, %d files)" %
+        (best["write"], outsize / 1e6 / max(best["write"], 1e-9), len(texts)))
+    print("stages: peak memory %.1fMB" % (peak / 1e6))
+    best["peak"] = peak / 1e6
+    return best
+
+class stat_finder:
+    # the pytempl import hook as it was: a stat per path entry for every import
+    def find_spec(self, fullname, pathlist=None, target=None):
+        filename = fullname.rpartition(".")[2] + ".pyt"
+        for dir in sys.path if pathlist is None else pathlist:
+            fullpath = os.path.join(dir, filename)
+            if os.path.isfile(fullpath):
+                return importlib.util.spec_from_file_location(fullname, fullpath,
+                    loader=pytempl.loader(fullpath))
+        return None
+
+def bench_imports(args, tmpdir):
+    # a long sys.path of directories with a few modules each; the imported
+    # modules are in the last one
+    dirs = []
+    for i in range(args.pathlen):
+        dirs.append(os.path.join(tmpdir, "path%d" % i))
+        os.makedirs(dirs[-1])
+        for j in range(5):
+            open(os.path.join(dirs[-1], "mod%d_%d.py" % (i, j)), "w").close()
+    names = ["benchmod%d" % i for i in range(args.files)]
+    for n in names:
+        open(os.path.join(dirs[-1], n + ".py"), "w").close()
+    missing = ["nosuchmod%d" % i for i in range(args.files)]
+    hook = next(f for f in sys.meta_path if hasattr(f, "__pytempl__"))
+    variants = [("none", None), ("stat", stat_finder()), ("cached", hook)]
+    path, meta = sys.path[:], sys.meta_path[:]
+    best = {}
+    try:
+        sys.path[:] = dirs + path
+        for r in range(args.repeat):
+            for k in range(len(variants)):
+                name, finder = variants[(k + r) % len(variants)]
+                sys.meta_path[:] = [f for f in meta if f is not hook] + ([finder] if finder else [])
+                importlib.invalidate_caches()
+                t = time.perf_counter()
+                for n in missing:
+                    try:
+                        importlib.import_module(n)
+                    except ImportError:
+                        pass
+                t1 = time.perf_counter()
+                for n in names:
+                    importlib.import_module(n)
+                t2 = time.perf_counter()
+                for n in names:
+                    del sys.modules[n]
+                for k, v in [(name + ".missing", t1 - t), (name + ".present", t2 - t1)]:
+                    best[k] = min(best.get(k, v), v)
+    finally:
+        sys.path[:], sys.meta_path[:] = path, meta
+        importlib.invalidate_caches()
+    for name, _ in variants:
+        print("imports: %-6s missing %.1fus/import, present %.1fus/import (%d path entries)" % (name,
+            best[name + ".missing"] * 1e6 / len(missing), best[name + ".present"] * 1e6 / len(names),
+            len(dirs)))
+    return best
+
+def importtime(cmd, pycache):
+    # total and top-level import times (seconds) reported by -X importtime and
+    # the names of all imported modules; bytecode is cached under pycache so
+    # that results do not depend on the environment or on whether the program
+    # directory is writable
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    proc = subprocess.run([sys.executable, "-X", "pycache_prefix=" + pycache, "-X", "importtime"] + cmd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, env=env)
+    total = 0
+    top = []
+    names = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        us, cumulative, name = line[len("import time:"):].split("|")
+        total += int(us)
+        names.add(name.strip())
+        if not name.startswith("  "):
+            top.append((int(cumulative), name.strip()))
+    if proc.returncode:
+        fail("%s failed" % " ".join(cmd))
+    return total / 1e6, sorted(top, reverse=True), names
+
+# modules that doxyfmt.py --help must not import
+help_excluded = ["doxylib", "pytempl", "subprocess", "xml.etree"]
+
+def bench_startup(args, tmpdir):
+    path, _ = corpus(args, tmpdir)
+    prog = os.path.join(progdir, "doxyfmt.py")
+    outdir = os.path.join(tmpdir, "out")
+    cmds = {
+        "pass": ["-c", "pass"],
+        "help": [prog, "--help"],
+        "run": [prog, "-x", os.path.dirname(path), "-o", outdir],
+    }
+    pycache = os.path.join(tmpdir, "pycache")
+    # the first run renders everything and caches bytecode
+    importtime(cmds["run"], pycache)
+    results = {}
+    for name, cmd in cmds.items():
+        best = wall = top = None
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            total, imports, names = importtime(cmd, pycache)
+            t = time.perf_counter() - t
+            if best is None or total < best:
+                best, top = total, imports
+            wall = t if wall is None else min(wall, t)
+        results[name + ".imports"] = best
+        results[name + ".wall"] = wall
+        if "pass" == name:
+            print("startup: %-4s imports %.1fms, wall %.1fms" % (name, best * 1e3, wall * 1e3))
+            continue
+        over = max(0, best - results["pass.imports"])
+        budget = getattr(args, "budget_" + name) / 1e3
+        print("startup: %-4s imports %.1fms (%.1fms over pass, budget %.1fms), wall %.1fms; %s" % (name,
+            best * 1e3, over * 1e3, budget * 1e3, wall * 1e3,
+            ", ".join("%s %.1fms" % (n, c / 1e3) for c, n in top[:4])))
+        if "help" == name:
+            imported = [m for m in help_excluded if m in names]
+            if imported:
+                fail("help imports %s" % ", ".join(imported), 2)
+        if over > budget:
+            fail("%s exceeds its import budget" % name, 2)
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for k, v in sorted(results.items()):
+        b = baseline.get(k)
+        if b is None:
+            continue
+        change = (v - b) / b if b else 0
+        print("baseline: %-16s %10.4f -> %10.4f (%+.1f%%)" % (k, b, v, change * 100))
+        if change > tolerance:
+            regressions.append(k)
+    return regressions
+
+benchmarks = {
+    "accessors": bench_accessors,
+    "backends": bench_backends,
+    "imports": bench_imports,
+    "maptext": bench_maptext,
+    "refresh": bench_refresh,
+    "render": bench_render,
+    "stages": bench_stages,
+    "startup": bench_startup,
+    "template": bench_template,
+}
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("benchmark", choices=["gen"] + sorted(benchmarks))
+    p.add_argument("dir", nargs="?",
+        help="output directory (gen only)")
+    p.add_argument("-x", dest="xml",
+        help="use existing doxygen xml directory instead of generating one")
+    p.add_argument("-F", dest="template", default=os.path.join(progdir, "formats", "markdown.pyt"),
+        help="format template file")
+    p.add_argument("-n", dest="files", type=int, default=100,
+        help="number of files")
+    p.add_argument("-s", dest="structs", type=int, default=3,
+        help="number of structs/unions per file")
+    p.add_argument("-m", dest="members", type=int, default=20,
+        help="number of members per file")
+    p.add_argument("-d", dest="depth", type=int, default=2,
+        help="nesting depth of lists in descriptions")
+    p.add_argument("-t", dest="typedefs", type=float, default=0.7,
+        help="fraction of typedefs that alias a struct")
+    p.add_argument("-P", dest="pathlen", type=int, default=200,
+        help="number of sys.path entries (imports only)")
+    p.add_argument("--budget-help", type=float, default=40,
+        help="import budget of doxyfmt.py --help over -c pass in ms (startup only)")
+    p.add_argument("--budget-run", type=float, default=80,
+        help="import budget of a no-op doxyfmt.py run over -c pass in ms (startup only)")
+    p.add_argument("-r", dest="repeat", type=int, default=3,
+        help="number of repetitions (best is reported)")
+    p.add_argument("--seed", type=int, default=1,
+        help="random seed")
+    p.add_argument("-b", dest="backend", choices=doxylib.parser.backends, default=doxylib.parser.backend,
+        help="parser backend (stages only)")
+    p.add_argument("--save", metavar="FILE",
+        help="save results to a JSON baseline file")
+    p.add_argument("--baseline", metavar="FILE",
+        help="compare results with a JSON baseline file")
+    p.add_argument("-T", dest="tolerance", type=float, default=0.1,
+        help="tolerated slowdown against the baseline (fraction)")
+    args = p.parse_args(sys.argv[1:])
+    if "gen" == args.benchmark:
+        if not args.dir:
+            fail("gen requires an output directory")
+        nmembers = generator(args.files, args.structs, args.members, args.depth,
+            args.typedefs, args.seed).write(args.dir)
+        print("%s: %d files, %d members" % (args.dir, args.files, nmembers))
+        return
+    params = { k: getattr(args, k) for k in ["files", "structs", "members", "depth",
+        "typedefs", "seed", "xml", "backend", "pathlen"] }
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = benchmarks[args.benchmark](args, tmpdir)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({ "benchmark": args.benchmark, "params": params, "results": results },
+                file, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if args.benchmark != baseline.get("benchmark") or params != baseline.get("params"):
+            warn("baseline was taken with a different benchmark or corpus")
+        regressions = compare(results, baseline.get("results", {}), args.tolerance)
+        if regressions:
+            fail("regressed: %s" % ", ".join(regressions), 2)
+
+def __entry():
+    try:
+        main()
+    except EnvironmentError as ex:
+        fail(ex)
+    except KeyboardInterrupt:
+        fail("interrupted", 130)
+
+if "__main__" == __name__:
+    __entry()
@@ -61,12 +61,9 @@
 # ---------
 # (C) 2014-2020 Bill Zissimopoulos
 
-import argparse, os, shutil, subprocess, sys
-from glob import glob
-
-sys.dont_write_bytecode = True
-import pytempl
-import doxylib
+# Modules that only some runs need (doxylib and pytempl among them) are imported
+# where they are used, so that startup (and --help in particular) stays fast.
+import argparse, os, re, sys, time
 
 def info(s):
     print("%s: %s" % (os.path.basename(sys.argv[0]), s))
@@ -76,40 +73,132 @@ def fail(s, exitcode = 1):
     warn(s)
     sys.exit(exitcode)
 
-def readconf(path):
+# Files named by @INCLUDE are read in place; as with doxygen they are looked up
+# in the directory of the configuration file and in the @INCLUDE_PATH
+# directories. The paths of the included files are appended to includes.
+# Environment variables $(VAR) in values are expanded (to nothing if unset).
+envvar_re = re.compile(r"\$\(([^)]*)\)")
+def readconf(path, includes = None):
     conf = {}
-    with open(path) as file:
-        cont = ""
-        for line in file:
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            if line.endswith("\\"):
-                cont += line[:-1]
-                continue
-            if cont:
-                line = cont + line
-                cont = ""
-            part = line.split("=", maxsplit=1)
-            if 2 != len(part):
-                continue
-            plus = False
-            if part[0].endswith("+"):
-                part[0] = part[0][:-1]
-                plus = True
-            part[0] = part[0].strip()
-            part[1] = part[1].strip()
-            if plus:
-                prev = conf.get(part[0], "")
-                if prev:
-                    part[1] = prev + " " + part[1]
-            conf[part[0]] = part[1]
+    incpath = [os.path.dirname(path)]
+    def include(name):
+        for dir in incpath:
+            p = os.path.join(dir, name)
+            if os.path.isfile(p):
+                return p
+        raise FileNotFoundError("@INCLUDE = %s: not found" % name)
+    def read(path):
+        with open(path) as file:
+            cont = ""
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.endswith("\\"):
+                    cont += line[:-1]
+                    continue
+                if cont:
+                    line = cont + line
+                    cont = ""
+                part = line.split("=", maxsplit=1)
+                if 2 != len(part):
+                    continue
+                plus = False
+                if part[0].endswith("+"):
+                    part[0] = part[0][:-1]
+                    plus = True
+                part[0] = part[0].strip()
+                part[1] = envvar_re.sub(lambda m: os.environ.get(m.group(1), ""), part[1].strip())
+                if "@INCLUDE_PATH" == part[0]:
+                    incpath.extend(os.path.join(incpath[0], p) for p in conflist(part[1]))
+                    continue
+                if "@INCLUDE" == part[0]:
+                    for name in conflist(part[1]):
+                        name = include(name)
+                        if includes is not None:
+                            includes.append(name)
+                        read(name)
+                    continue
+                if plus:
+                    prev = conf.get(part[0], "")
+                    if prev:
+                        part[1] = prev + " " + part[1]
+                conf[part[0]] = part[1]
+    read(path)
     return conf
 
-def run():
-    path = args.file
-    xdir = os.path.join(args.conf["outdir"], "xml")
-    conf = readconf(path)
+# doxygen's FILE_PATTERNS default
+default_patterns = """
+    *.c *.cc *.cxx *.cpp *.c++ *.java *.ii *.ixx *.ipp *.i++ *.inl *.idl *.ddl *.odl
+    *.h *.hh *.hxx *.hpp *.h++ *.cs *.d *.php *.php4 *.php5 *.phtml *.inc *.m *.markdown
+    *.md *.mm *.dox *.py *.pyw *.f90 *.f95 *.f03 *.f08 *.f18 *.f *.for *.vhd *.vhdl
+    *.ucf *.qsf *.ice
+    """.split()
+
+def conflist(value):
+    return [a or b for a, b in re.findall(r'"([^"]*)"|(\S+)', value or "")]
+
+def inputfiles(conf, cwd):
+    import fnmatch
+    patterns = conflist(conf.get("FILE_PATTERNS")) or default_patterns
+    recursive = "YES" == conf.get("RECURSIVE", "NO")
+    exclude = [os.path.join(cwd, p) for p in conflist(conf.get("EXCLUDE"))]
+    expatterns = conflist(conf.get("EXCLUDE_PATTERNS"))
+    def excluded(path):
+        return any(path == p or path.startswith(p + os.sep) for p in exclude) or \
+            any(fnmatch.fnmatch(path, p) for p in expatterns)
+    files = []
+    for i in conflist(conf.get("INPUT")) or ["."]:
+        i = os.path.normpath(os.path.join(cwd, i))
+        if os.path.isfile(i):
+            if not excluded(i):
+                files.append(i)
+            continue
+        for root, dirs, names in os.walk(i):
+            if not recursive:
+                dirs[:] = []
+            dirs.sort()
+            for n in sorted(names):
+                n = os.path.join(root, n)
+                if any(fnmatch.fnmatch(os.path.basename(n), p) for p in patterns) and not excluded(n):
+                    files.append(n)
+    return files
+
+def fingerprint(doxy, conf, files, shards):
+    import hashlib, subprocess
+    h = hashlib.sha1()
+    h.update(subprocess.run([doxy, "--version"],
+        stdout=subprocess.PIPE, check=True).stdout)
+    h.update("\n".join("%s=%s" % (k, v) for k, v in sorted(conf.items())).encode("utf-8"))
+    h.update(("\nshards=%d" % shards).encode("utf-8"))
+    for path in files:
+        with open(path, "rb") as file:
+            h.update(("\n%s\n" % path).encode("utf-8"))
+            h.update(hashlib.sha1(file.read()).digest())
+    return h.hexdigest()
+
+def doxygen(doxy, confs, cwd):
+    # run one doxygen process per configuration in parallel
+    import subprocess
+    procs = []
+    try:
+        for conf in confs:
+            os.makedirs(conf["XML_OUTPUT"], exist_ok=True)
+            proc = subprocess.Popen([doxy, "-"], stdin=subprocess.PIPE, cwd=cwd)
+            procs.append(proc)
+            proc.stdin.write("\n".join("%s=%s" % (k, v) for k, v in conf.items()).encode("utf-8"))
+            proc.stdin.close()
+        for proc in procs:
+            if 0 != proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+def doxyconf(path, xdir, includes = None):
+    conf = readconf(path, includes)
     for k in conf:
         if k.startswith("GENERATE_"):
             conf[k] = "NO"
@@ -124,40 +213,211 @@ def run():
     conf["GENERATE_XML"] = "YES"
     conf["XML_PROGRAMLISTING"] = "NO"
     conf["XML_OUTPUT"] = xdir
+    return conf
+
+def generate(path, conf, files, xdir):
+    import shutil
     doxy = shutil.which("doxygen")
     if not doxy:
         if sys.platform.startswith("win32"):
             doxy = r"C:\Program Files\Doxygen\bin\doxygen.exe"
-    os.makedirs(xdir, exist_ok=True)
-    subprocess.run(
-        [doxy, "-"],
-        input="\n".join("%s=%s" % (k, v) for k, v in conf.items()).encode("utf-8"),
-        cwd=os.path.dirname(path) or None,
-        check=True)
-    p = doxylib.parser(os.path.join(xdir, "index.xml"))
-    conf.update(args.conf)
-    args.template.main(conf, p.index)
+    # shard the input files and run doxygen over each shard into its own xml directory
+    shards = [files[i::args.shards] for i in range(min(args.shards, len(files)))]
+    if 1 < len(shards):
+        confs = [dict(conf,
+            INPUT=" ".join('"%s"' % f for f in shard),
+            XML_OUTPUT=os.path.join(xdir, "shard%d" % i)) for i, shard in enumerate(shards)]
+    else:
+        confs = [conf]
+    # reuse a retained xml tree (-k or -w) if config, inputs and doxygen version are
+    # unchanged; the output of input filters is not known, so filtered inputs are
+    # never reused. Without -k or -w the tree is removed after the run, so no
+    # fingerprint is taken.
+    fpath = os.path.join(xdir, "doxyfmt.fingerprint")
+    fprint = None
+    cached = False
+    if (args.keep_xml or args.watch) and not conf.get("INPUT_FILTER") and not conf.get("FILTER_PATTERNS"):
+        fprint = fingerprint(doxy, conf, files, len(confs))
+        try:
+            with open(fpath) as file:
+                cached = fprint == file.read().strip()
+        except EnvironmentError:
+            pass
+    if not cached:
+        os.makedirs(xdir, exist_ok=True)
+        if os.path.exists(fpath):
+            os.remove(fpath)
+        doxygen(doxy, confs, os.path.dirname(path) or None)
+        if fprint is not None:
+            with open(fpath, "w") as file:
+                file.write(fprint + "\n")
+    return [os.path.join(c["XML_OUTPUT"], "index.xml") for c in confs]
+
+def xmlindex(dirs):
+    # index.xml of each directory, or of its shard subdirectories (as left by -s -k)
+    paths = []
+    for dir in dirs:
+        path = os.path.join(dir, "index.xml")
+        if os.path.isfile(path):
+            paths.append(path)
+            continue
+        i = len(paths)
+        while os.path.isfile(os.path.join(dir, "shard%d" % (len(paths) - i), "index.xml")):
+            paths.append(os.path.join(dir, "shard%d" % (len(paths) - i), "index.xml"))
+        if i == len(paths):
+            fail("no index.xml in %s" % dir)
+    return paths
+
+def parse(paths):
+    import doxylib
+    p = doxylib.parser(paths,
+        int(args.conf.get("cachesize", doxylib.parser.cachesize)), args.conf.get("backend"))
+    for id, dir1, dir2 in p.collisions:
+        warn("refid %s found in both %s and %s" % (id, dir1, dir2))
+    return p
+
+def render(conf, index):
+    # render every template from the one parse; with several templates each
+    # renders into its own subdirectory of outdir, named after the template
+    os.makedirs(conf["outdir"], exist_ok=True)
+    for name, tpath, template in args.templates:
+        tconf = dict(conf, template=tpath, template_digest=template._pytempl_digest)
+        if 1 < len(args.templates):
+            tconf["outdir"] = os.path.join(conf["outdir"], name)
+            os.makedirs(tconf["outdir"], exist_ok=True)
+        t = time.perf_counter()
+        template.main(tconf, index)
+        if conf.get("profile"):
+            conf["profile"].stage("render " + name, time.perf_counter() - t)
+
+def report(prof):
+    import json
+    prof.report(sys.stdout)
+    if args.profile_json:
+        with open(args.profile_json, "w") as file:
+            json.dump(prof.json(), file, indent=1)
+
+def snapshot(paths):
+    snap = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+            snap[path] = (st.st_mtime_ns, st.st_size)
+        except EnvironmentError:
+            snap[path] = None
+    return snap
+
+def watchlist(path, xdir, cwd):
+    includes = []
+    try:
+        conf = doxyconf(path, xdir, includes)
+        return [path] + includes + inputfiles(conf, cwd)
+    except EnvironmentError:
+        return [path] + includes
+
+def run():
+    import doxylib
+    path = args.file
+    if args.xml_dirs:
+        # render from an existing xml tree; doxygen is not run
+        prof = doxylib.profile() if args.profile else None
+        conf = readconf(path) if os.path.isfile(path) else {}
+        t = time.perf_counter()
+        p = parse(xmlindex(args.xml_dirs))
+        if prof:
+            prof.stage("index", time.perf_counter() - t)
+        conf.update(args.conf)
+        conf["profile"] = prof
+        render(conf, p.index)
+        if prof:
+            report(prof)
+        return
+    import shutil, subprocess
+    xdir = os.path.join(args.conf["outdir"], "xml")
+    cwd = os.path.dirname(os.path.abspath(path))
+    interval = float(args.conf.get("interval", 1))
+    p = None
+    while True:
+        start = time.time()
+        prof = doxylib.profile() if args.profile else None
+        includes = []
+        conf = doxyconf(path, xdir, includes)
+        files = inputfiles(conf, cwd)
+        snap = snapshot([path] + includes + files)
+        try:
+            t = time.perf_counter()
+            paths = generate(path, conf, files, xdir)
+            if prof:
+                prof.stage("doxygen", time.perf_counter() - t)
+        except subprocess.CalledProcessError as ex:
+            # a failed rebuild does not end watch mode
+            if not args.watch:
+                fail(ex)
+            warn(ex)
+            paths = None
+        if paths is not None:
+            # in watch mode the parser and its compound cache are kept between
+            # rebuilds; only compounds whose xml changed are parsed again
+            t = time.perf_counter()
+            if p is not None and p.path == paths:
+                p.refresh()
+            else:
+                p = parse(paths)
+            if prof:
+                prof.stage("index", time.perf_counter() - t)
+            conf.update(args.conf)
+            conf["profile"] = prof
+            render(conf, p.index)
+            if prof:
+                report(prof)
+        if not args.watch:
+            break
+        info("built in %.3fs; watching %d files" % (time.time() - start, len(files)))
+        # poll the Doxyfile and the INPUT set until something changes
+        try:
+            while snap == snapshot(watchlist(path, xdir, cwd)):
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            break
     if not args.keep_xml:
         shutil.rmtree(xdir, ignore_errors=True)
 
 def main():
     global args
     progdir = os.path.dirname(sys.argv[0])
-    formats = [os.path.basename(f)[:-len(".pyt")]
-        for f in glob(os.path.join(os.path.join(progdir, "formats", "*.pyt")))]
+    try:
+        formats = sorted(f[:-len(".pyt")]
+            for f in os.listdir(os.path.join(progdir, "formats")) if f.endswith(".pyt"))
+    except EnvironmentError:
+        formats = []
     p = argparse.ArgumentParser()
-    p.add_argument("-f", dest="format", choices=formats, default="markdown",
-        help="output format")
-    p.add_argument("-F", dest="template",
-        help="format template file (overrides -f)")
+    p.add_argument("-f", dest="formats", action="append", choices=formats,
+        help="output format (may be repeated)")
+    p.add_argument("-F", dest="templates", action="append",
+        help="format template file (may be repeated)")
     p.add_argument("-c", dest="conflist", action="append", metavar="NAME=VALUE",
         help="set configuration value")
+    p.add_argument("-j", dest="jobs", type=int, default=1, metavar="N",
+        help="number of parallel rendering jobs")
     p.add_argument("-k", dest="keep_xml", action="store_true",
         help="keep doxygen xml files")
+    p.add_argument("-s", dest="shards", type=int, default=1, metavar="N",
+        help="number of parallel doxygen shards")
+    p.add_argument("-w", "--watch", dest="watch", action="store_true",
+        help="watch the input files and rebuild when they change")
+    p.add_argument("-x", "--xml-dir", dest="xml_dirs", action="append", metavar="DIR",
+        help="render from existing doxygen xml in DIR instead of running doxygen (may be repeated)")
+    p.add_argument("--shard", dest="shard", metavar="K/N",
+        help="render only the K-th of N shards of the files")
+    p.add_argument("-p", "--profile", dest="profile", action="store_true",
+        help="report timings and counters of the run")
+    p.add_argument("--profile-json", dest="profile_json", metavar="FILE",
+        help="also save the profile as JSON to FILE (implies -p)")
     p.add_argument("-o", dest="outdir",
         help="output directory")
     p.add_argument("file", nargs="?", default="Doxyfile")
     args = p.parse_args(sys.argv[1:])
+    import pytempl, doxylib
     args.conf = {}
     for i in args.conflist or []:
         p = i.split("=", maxsplit=1)
@@ -167,9 +427,34 @@ def main():
             args.conf[p[0]] = True
     args.conf.setdefault("outdir", args.outdir or ".")
     args.conf["outdir"] = os.path.abspath(args.conf["outdir"])
-    if args.template is None:
-        args.template = os.path.join(progdir, "formats", args.format + ".pyt")
-    args.template = pytempl.template_load(args.template)
+    args.conf.setdefault("jobs", args.jobs)
+    if args.conf.get("backend", doxylib.parser.backend) not in doxylib.parser.backends:
+        fail("unknown backend: %s" % args.conf["backend"])
+    if args.profile_json:
+        args.profile = True
+    if args.shard:
+        args.conf["shard"] = args.shard
+    if args.conf.get("shard"):
+        try:
+            doxylib.shardspec(args.conf["shard"])
+        except ValueError:
+            fail("invalid shard: %s" % args.conf["shard"])
+    if args.watch and args.xml_dirs:
+        fail("cannot watch existing xml")
+    paths = [os.path.join(progdir, "formats", f + ".pyt") for f in args.formats or []] + \
+        (args.templates or [])
+    if not paths:
+        paths = [os.path.join(progdir, "formats", "markdown.pyt")]
+    templates = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        path = os.path.abspath(path)
+        if name in templates:
+            if templates[name] == path:
+                continue
+            fail("duplicate format name: %s" % name)
+        templates[name] = path
+    args.templates = [(name, path, pytempl.template_load(path)) for name, path in templates.items()]
     run()
 
 def __entry():
@@ -177,8 +462,6 @@ def __entry():
         main()
     except EnvironmentError as ex:
         fail(ex)
-    except subprocess.CalledProcessError as ex:
-        fail(ex)
     except KeyboardInterrupt:
         fail("interrupted", 130)
 
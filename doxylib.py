@@ -7,7 +7,8 @@
 # It is licensed under the MIT license. The full license text can be found
 # in the License.txt file at the root of this project.
 
-import os, re, xml.etree.ElementTree as ET
+import array, collections, functools, hashlib, io, json, os, re, struct, sys, threading, time, types, zlib
+import xml.etree.ElementTree as ET, xml.etree.ElementPath as ElementPath
 from itertools import chain
 
 def itermaptext(elem, escape, textmap, tailmap, filter = None):
@@ -44,11 +45,379 @@ def itermaptext(elem, escape, textmap, tailmap, filter = None):
         elif t:
             yield escape(t)
 
+# A mapper compiles a (textmap, tailmap, filter) triple into a dispatch
+# table and maps the text of an element tree the same way itermaptext does,
+# but walks the tree with an explicit stack and appends to a single buffer.
+class mapper:
+    def __init__(self, escape, textmap, tailmap, filter = None):
+        self.escape = escape or (lambda t: t)
+        textmap = textmap or {}
+        tailmap = tailmap or {}
+        filter = filter or {}
+        self.table = {}
+        for g in chain(textmap, tailmap, filter):
+            self.table[g] = self.__compile(textmap.get(g)) + self.__compile(tailmap.get(g)) + \
+                (filter.get(g, True),)
+        self.default = (None, None, None, None, True)
+    # Compiled mappers are kept for the most recent cachesize (escape, textmap,
+    # tailmap, filter) combinations, keyed by escape (bound methods compare
+    # equal when they bind the same function to the same object) and by the
+    # identity of the maps, which the cache holds on to. Maps must not be
+    # modified once they have been used.
+    cachesize = 64
+    __cache = collections.OrderedDict()
+    @classmethod
+    def cached(cls, escape, textmap, tailmap, filter = None):
+        key = (escape, id(textmap), id(tailmap), id(filter))
+        try:
+            entry = cls.__cache.get(key)
+        except TypeError:
+            # unhashable escape
+            return cls(escape, textmap, tailmap, filter)
+        if entry is None:
+            entry = cls.__cache[key] = (cls(escape, textmap, tailmap, filter), textmap, tailmap, filter)
+            while cls.cachesize < len(cls.__cache):
+                cls.__cache.popitem(last=False)
+        return entry[0]
+    @staticmethod
+    def __compile(f):
+        # (format, strip) for formats, (callable, None) for callables
+        if not f:
+            return (None, None)
+        if callable(f):
+            return (f, None)
+        if "%T" == f[:2]:
+            return (f[2:], True)
+        return (f, False)
+    def __call__(self, elem):
+        elem = elem.XMLElement
+        if "" == elem.tag:
+            return ""
+        escape = self.escape
+        table = self.table
+        default = self.default
+        buf = []
+        append = buf.append
+        entry = table.get(elem.tag, default)
+        f, strip = entry[0], entry[1]
+        t = elem.text or ""
+        if f is not None:
+            if strip is None:
+                f = f(elem)
+                if "%T" == f[:2]:
+                    f = f[2:]
+                    t = t and t.lstrip()
+            elif strip:
+                t = t and t.lstrip()
+            append(f % escape(t))
+        elif t:
+            append(escape(t))
+        stack = [(elem, entry, iter(elem))]
+        while stack:
+            for e in stack[-1][2]:
+                entry = table.get(e.tag, default)
+                c = entry[4]
+                if c is not True:
+                    if callable(c):
+                        c = c(e)
+                    if not c:
+                        continue
+                f, strip = entry[0], entry[1]
+                t = e.text or ""
+                if f is not None:
+                    if strip is None:
+                        f = f(e)
+                        if "%T" == f[:2]:
+                            f = f[2:]
+                            t = t and t.lstrip()
+                    elif strip:
+                        t = t and t.lstrip()
+                    append(f % escape(t))
+                elif t:
+                    append(escape(t))
+                stack.append((e, entry, iter(e)))
+                break
+            else:
+                e, entry, _ = stack.pop()
+                if not stack:
+                    break
+                f, strip = entry[2], entry[3]
+                t = e.tail or ""
+                if f is not None:
+                    if strip is None:
+                        f = f(e)
+                        if "%T" == f[:2]:
+                            f = f[2:]
+                            t = t and t.lstrip()
+                    elif strip:
+                        t = t and t.lstrip()
+                    append(f % escape(t))
+                elif t:
+                    append(escape(t))
+        return "".join(buf)
+
+# An escaper applies a list of (pattern, replacement) rules in a single
+# pass; its result is the same as applying the rules with re.sub one after
+# the other, provided that a rule never matches text inserted by an earlier
+# rule. Groups captured by a rule are escaped with the rules before it.
+# Patterns must not contain backreferences. Short strings are memoized.
+class escaper:
+    cachesize = 4096
+    maxlen = 64
+    _flags_re = re.compile(r"^\(\?[aiLmsux]+\)")
+    def __init__(self, rules, cachesize=None):
+        rules = [(re.compile(p) if isinstance(p, str) else p, r) for p, r in rules]
+        cachesize = self.cachesize if cachesize is None else cachesize
+        self.rules = rules
+        self.__re = None
+        self.__cached = self.__escape
+        if not rules:
+            return
+        self.__rules = {}
+        parts = []
+        base = 0
+        for i, (p, r) in enumerate(rules):
+            flags = "".join(f for f, v in [("i", re.I), ("m", re.M), ("s", re.S), ("x", re.X)]
+                if p.flags & v)
+            pattern = self._flags_re.sub("", p.pattern)
+            parts.append("(%s)" % ("(?%s:%s)" % (flags, pattern) if flags else pattern))
+            prior = escaper(rules[:i], 0) if i else None
+            self.__rules[base + 1] = (base + 1, self.__template(p, r), prior)
+            base += 1 + p.groups
+        self.__re = re.compile("|".join(parts))
+        if cachesize:
+            self.__cached = functools.lru_cache(cachesize)(self.__escape)
+    def __call__(self, text):
+        if len(text) <= self.maxlen:
+            return self.__cached(text)
+        return self.__escape(text)
+    def __escape(self, text):
+        if self.__re is None or self.__re.search(text) is None:
+            return text
+        return self.__re.sub(self.__sub, text)
+    def __sub(self, m):
+        base, template, prior = self.__rules[m.lastindex]
+        if prior is None:
+            return "".join(p if str == type(p) else m.group(base + p) or "" for p in template)
+        return "".join(p if str == type(p) else prior(m.group(base + p) or "") for p in template)
+    @staticmethod
+    def __template(pattern, repl):
+        # expand repl once with placeholder characters in place of the groups,
+        # then split it into literal strings and group numbers
+        names = {v: k for k, v in pattern.groupindex.items()}
+        fake = re.compile("".join("(?P<%s>.)" % names[i] if i in names else "(.)"
+            for i in range(1, pattern.groups + 1)), re.DOTALL)
+        m = fake.match("".join(chr(0xf0000 + i) for i in range(1, pattern.groups + 1)))
+        parts = re.split("([\U000f0000-\U000fffff])", m.expand(repl))
+        return [p if 0 == i % 2 else ord(p) - 0xf0000 for i, p in enumerate(parts) if p]
+    def cache_stats(self):
+        if self.__cached == self.__escape:
+            return { "hits": 0, "misses": 0, "size": 0, "cachesize": 0 }
+        info = self.__cached.cache_info()
+        return { "hits": info.hits, "misses": info.misses, "size": info.currsize,
+            "cachesize": info.maxsize }
+
+# Compile an accessor string such as "nameS", "locationE" or
+# ".//simplesect[@kind='return']E" into a function of an element.
+# Compiled accessors are kept for the lifetime of the process.
+def accessor(name):
+    fn = _accessors.get(name)
+    if fn is None:
+        fn = _accessors[name] = _compile_accessor(name)
+    return fn
+_accessors = {}
+def _compile_accessor(name):
+    conv = name[-1:]
+    name = name[:-1]
+    if conv == "A":
+        if name:
+            return lambda e: e.XMLElement.get(name)
+        else:
+            return lambda e: ""
+    elif conv == "E":
+        if name:
+            return lambda e: element(e.XMLElement.find(name))
+        else:
+            return lambda e: e
+    elif conv == "L":
+        if name:
+            return lambda e: [element(x) for x in e.XMLElement.findall(name)]
+        else:
+            return lambda e: [e]
+    elif conv == "N":
+        if name:
+            def fn(e):
+                XMLElement = e.XMLElement.find(name)
+                return XMLElement.tag if XMLElement is not None else ""
+            return fn
+        else:
+            return lambda e: e.XMLElement.tag
+    elif conv == "S" or conv == "T":
+        strip = conv == "T"
+        if name:
+            def fn(e):
+                attr = e.XMLElement.get(name)
+                if attr is not None:
+                    return attr
+                result = "".join(chain.from_iterable(x.itertext()
+                    for x in e.XMLElement.findall(name)))
+                return result.strip() if strip else result
+        elif strip:
+            def fn(e):
+                return "".join(e.XMLElement.itertext()).strip()
+        else:
+            def fn(e):
+                return "".join(e.XMLElement.itertext())
+        return fn
+    else:
+        def fn(e):
+            raise AttributeError(conv)
+        return fn
+
+_tag_re = re.compile(r"^[A-Za-z_][\w.-]*$")
+_noattrib = types.MappingProxyType({})
+# A node is a lightweight stand-in for ET.Element, used by the parser backends
+# other than "etree". It supports the subset of the Element API that doxylib and
+# the templates use; find/findall/iterfind accept the same ElementPath syntax.
+class node:
+    __slots__ = ("tag", "attrib", "text", "tail", "children")
+    def __init__(self, tag, attrib = None, text = None, tail = None):
+        # nodes without attributes or children share empty immutable ones
+        self.tag = tag
+        self.attrib = attrib or _noattrib
+        self.text = text
+        self.tail = tail
+        self.children = ()
+    def __repr__(self):
+        return "<node %r at %#x>" % (self.tag, id(self))
+    def __len__(self):
+        return len(self.children)
+    def __iter__(self):
+        return iter(self.children)
+    def __getitem__(self, index):
+        return self.children[index]
+    def get(self, key, default = None):
+        return self.attrib.get(key, default)
+    def keys(self):
+        return self.attrib.keys()
+    def items(self):
+        return self.attrib.items()
+    def find(self, path):
+        if _tag_re.match(path):
+            for e in self.children:
+                if path == e.tag:
+                    return e
+            return None
+        return ElementPath.find(self, path)
+    def findall(self, path):
+        if _tag_re.match(path):
+            return [e for e in self.children if path == e.tag]
+        return ElementPath.findall(self, path)
+    def iterfind(self, path):
+        return ElementPath.iterfind(self, path)
+    def findtext(self, path, default = None):
+        return ElementPath.findtext(self, path, default)
+    def iter(self, tag = None):
+        if "*" == tag:
+            tag = None
+        todo = [self]
+        while todo:
+            e = todo.pop()
+            if tag is None or tag == e.tag:
+                yield e
+            todo.extend(reversed(e.children))
+    def itertext(self):
+        todo = [self]
+        while todo:
+            e = todo.pop()
+            if isinstance(e, str):
+                yield e
+                continue
+            if e.text:
+                yield e.text
+            for c in reversed(e.children):
+                if c.tail:
+                    todo.append(c.tail)
+                todo.append(c)
+    def makeelement(self, tag, attrib):
+        return node(tag, dict(attrib))
+    def append(self, e):
+        if self.children:
+            self.children.append(e)
+        else:
+            self.children = [e]
+    def extend(self, elements):
+        self.children = list(self.children) + list(elements)
+    def remove(self, e):
+        for i, c in enumerate(self.children):
+            if c is e:
+                del self.children[i]
+                return
+        raise ValueError("node.remove(x): x not in list")
+
+# Build a tree of nodes from an xml file with expat. Tag and attribute names
+# are interned; names, text and tails come out as they do from ElementTree.
+def expat_parse(file):
+    from xml.parsers import expat
+    intern = sys.intern
+    stack = []
+    last = [None, False]    # node that receives character data; is it a tail?
+    def name(n):
+        # namespaced names come as "uri}local"; ElementTree spells them "{uri}local"
+        return intern("{" + n if "}" in n else n)
+    def start(tag, attrib):
+        n = node(name(tag), {name(k): v for k, v in attrib.items()} if attrib else None)
+        if stack:
+            stack[-1].append(n)
+        stack.append(n)
+        last[0], last[1] = n, False
+    def end(tag):
+        last[0], last[1] = stack.pop(), True
+    def data(text):
+        n, tail = last
+        if tail:
+            n.tail = n.tail + text if n.tail else text
+        elif n is not None:
+            n.text = n.text + text if n.text else text
+    p = expat.ParserCreate(None, "}")
+    p.buffer_text = True
+    p.StartElementHandler = start
+    p.EndElementHandler = end
+    p.CharacterDataHandler = data
+    try:
+        p.ParseFile(file)
+    except expat.ExpatError as ex:
+        raise ET.ParseError(str(ex))
+    return last[0]
+
+# Massage a compounddef so that its innerclass elements appear inside a
+# sectiondef of kind "innerclass" (at the end of the compounddef). This is
+# idempotent; returns True if the compounddef was modified.
+def innerclass_section(e):
+    incl = e.findall("innerclass")
+    if not incl:
+        return False
+    for i in incl:
+        e.remove(i)
+    sect = e.find("sectiondef[@kind='innerclass']")
+    if sect is None:
+        sect = e.makeelement("sectiondef", { "kind": "innerclass" })
+        e.append(sect)
+    sect.extend(incl)
+    return True
+
+# number of element accessor evaluations (lookups not answered from the cache)
+lookups = 0
+
+# An element memoizes the results of its accessors. Call invalidate() after
+# modifying the XMLElement.
 class element:
+    __slots__ = ("XMLElement", "cache")
     def __init__(self, XMLElement):
         if XMLElement is None:
             XMLElement = ET.Element("")
         self.XMLElement = XMLElement
+        self.cache = {}
     def __str__(self):
         return str(self.XMLElement)
     def __bool__(self):
@@ -56,80 +425,639 @@ class element:
     def __getitem__(self, name):
         return self.__getattr__(name)
     def __getattr__(self, name):
-        conv = name[-1:]
-        name = name[:-1]
-        if conv == "A":
-            if name:
-                return self.XMLElement.get(name)
-            else:
-                return ""
-        elif conv == "E":
-            if name:
-                return element(self.XMLElement.find(name))
-            else:
-                return self
-        elif conv == "L":
-            if name:
-                return [element(e) for e in self.XMLElement.findall(name)]
-            else:
-                return [self]
-        elif conv == "N":
-            if name:
-                XMLElement = self.XMLElement.find(name)
-                return XMLElement.tag if XMLElement is not None else ""
-            else:
-                return self.XMLElement.tag
-        elif conv == "S" or conv == "T":
-            if name:
-                attr = self.XMLElement.get(name)
-                if attr is not None:
-                    return attr
-                result = "".join(
-                    chain.from_iterable(e.itertext() for e in self.XMLElement.findall(name)))
-            else:
-                result = "".join(self.XMLElement.itertext())
-            return result if conv == "S" else result.strip()
-        else:
-            raise AttributeError
+        cache = self.cache
+        value = cache.get(name, cache)
+        if value is cache:
+            global lookups
+            value = cache[name] = (_accessors.get(name) or accessor(name))(self)
+            lookups += 1
+        return value
+    def invalidate(self):
+        self.cache.clear()
     def Maptext(self, escape, textmap, tailmap, filter = None):
-        if "" == self.XMLElement.tag:
-            return ""
-        escape = escape or (lambda t: t)
-        textmap = textmap or {}
-        tailmap = tailmap or {}
-        return "".join(itermaptext(self.XMLElement, escape, textmap, tailmap, filter))
+        return mapper.cached(escape, textmap, tailmap, filter)(self)
 
 class compound:
-    def __init__(self, parser, ref):
+    def __init__(self, parser, ref, dir = None):
         self.parser = parser
         self.cref = ref
-        self.cdef = None
+        self.hash = None
+        self.dir = dir or parser.indexDir
     def __str__(self):
         return str(self.cref)
+    def digest(self):
+        if self.hash is None:
+            self.hash = self.parser.digest_compound(self.cref.refidA)
+        return self.hash
     def element(self):
-        if self.cdef is None:
-            self.cdef = self.parser.parse_compound(self.cref.refidA)
-        return self.cdef
+        return self.parser.compound_element(self.cref.refidA)
 
-class parser:
+# A symbols table holds every compound and member: kind, name, location, the
+# compound that a typedef aliases and the compound that owns each symbol.
+# Strings are interned and the fields of symbol i are kept at index i of
+# compact arrays; -1 stands for a missing value.
+class symbols:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+        self.__strings = {}
+        self.refids = array.array("i")
+        self.kinds = array.array("i")
+        self.names = array.array("i")
+        self.files = array.array("i")
+        self.lines = array.array("i")
+        self.columns = array.array("i")
+        self.aliases = array.array("i")
+        self.owners = array.array("i")
+        self.aliasedby = {}
+        self.__owners = {}
+    def __len__(self):
+        return len(self.refids)
+    def __contains__(self, id):
+        return id in self.ids
+    def __getstate__(self):
+        # strings no longer used by any symbol (see without) are left out
+        text = (self.refids, self.kinds, self.names, self.files, self.aliases, self.owners)
+        used = sorted(set(chain.from_iterable(text)).difference([-1]))
+        if len(used) == len(self.strings):
+            return (self.strings, self.refids, self.kinds, self.names, self.files, self.lines,
+                self.columns, self.aliases, self.owners)
+        remap = {i: k for k, i in enumerate(used)}
+        remap[-1] = -1
+        refids, kinds, names, files, aliases, owners = (array.array("i", [remap[i] for i in a])
+            for a in text)
+        return ([self.strings[i] for i in used], refids, kinds, names, files, self.lines,
+            self.columns, aliases, owners)
+    def __setstate__(self, state):
+        self.__init__()
+        (self.strings, self.refids, self.kinds, self.names, self.files, self.lines,
+            self.columns, self.aliases, self.owners) = state
+        self.__strings = {s: i for i, s in enumerate(self.strings)}
+        for i, r in enumerate(self.refids):
+            self.ids[self.strings[r]] = i
+            if -1 != self.aliases[i]:
+                self.aliasedby.setdefault(self.strings[self.aliases[i]], []).append(self.strings[r])
+    def intern(self, s):
+        if s is None:
+            return -1
+        i = self.__strings.get(s)
+        if i is None:
+            i = self.__strings[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+    def string(self, i):
+        return self.strings[i] if 0 <= i else None
+    def add(self, id, kind, name, location, owner, alias = None):
+        file = line = column = None
+        if location is not None:
+            file, line, column = location.get("file"), location.get("line"), location.get("column")
+        self.append(id, kind, name, file, int(line) if line is not None else -1,
+            int(column) if column is not None else -1, owner, alias)
+    def append(self, id, kind, name, file, line, column, owner, alias):
+        if id in self.ids:
+            return
+        self.ids[id] = len(self.refids)
+        self.refids.append(self.intern(id))
+        self.kinds.append(self.intern(kind))
+        self.names.append(self.intern(name))
+        self.files.append(self.intern(file))
+        self.lines.append(line)
+        self.columns.append(column)
+        self.aliases.append(self.intern(alias))
+        self.owners.append(self.intern(self.__owners.pop(id, owner)))
+        if alias is not None:
+            self.aliasedby.setdefault(alias, []).append(id)
+    # Return a copy of the table without the symbols that the compounds ids
+    # define: the compounds themselves and their members (symbols owned by them
+    # that are not in compounds, the set of all compound ids). The compounds
+    # that they own lose their owner until it is recorded again, while their
+    # own owners are kept for when they are added again.
+    def without(self, ids, compounds):
+        S = self.strings
+        drop = {self.__strings[id] for id in ids if id in self.__strings}
+        keep, owners, pending = [], array.array("i"), []
+        for i, (r, o) in enumerate(zip(self.refids, self.owners)):
+            if r in drop:
+                if -1 != o and o not in drop:
+                    pending.append((S[r], S[o]))
+                continue
+            if o in drop:
+                if S[r] not in compounds:
+                    continue
+                o = -1
+            keep.append(i)
+            owners.append(o)
+        symtab = symbols.__new__(symbols)
+        symtab.__setstate__([list(S)] + [array.array("i", [a[i] for i in keep]) for a in
+            (self.refids, self.kinds, self.names, self.files, self.lines, self.columns, self.aliases)] +
+            [owners])
+        for id, owner in pending:
+            symtab.own(id, owner)
+        return symtab
+    def own(self, id, owner):
+        # record the owner of an inner compound, which may not have been added yet
+        i = self.ids.get(id)
+        if i is None:
+            self.__owners.setdefault(id, owner)
+        elif -1 == self.owners[i]:
+            self.owners[i] = self.intern(owner)
+    def kind(self, id):
+        i = self.ids.get(id)
+        return self.strings[self.kinds[i]] if i is not None else None
+    def name(self, id):
+        i = self.ids.get(id)
+        return self.string(self.names[i]) if i is not None else None
+    def location(self, id):
+        i = self.ids.get(id)
+        if i is None:
+            return None
+        line, column = self.lines[i], self.columns[i]
+        return (self.string(self.files[i]),
+            str(line) if -1 != line else None, str(column) if -1 != column else None)
+    def sortkey(self, id):
+        location = self.location(id)
+        return "%s:%10s:%10s" % location if location else None
+    def alias(self, id):
+        i = self.ids.get(id)
+        return self.string(self.aliases[i]) if i is not None else None
+    def owner(self, id):
+        i = self.ids.get(id)
+        return self.string(self.owners[i]) if i is not None else None
+    def within(self, id, owner):
+        # is id owned by owner, directly or through enclosing compounds?
+        seen = set()
+        while id is not None and id not in seen:
+            if id == owner:
+                return True
+            seen.add(id)
+            id = self.owner(id)
+        return False
+
+# An ir is a compact binary image of the compounds of a doxygen xml tree:
+# interned strings and a flat node table in preorder, where node i is a child of
+# node parents[i] and owns the attributes from attrs[i] to attrs[i + 1]; the
+# nodes of a compound run from roots[id] to the root of the next compound.
+# The file is mapped with mmap; compounds are built into nodes on demand.
+# The image also carries the symbols table (its strings and arrays, see
+# symbols.__getstate__) and the fingerprint of the xml files it was compiled
+# from. An image that is truncated or otherwise does not add up is invalid.
+class ir:
+    magic = b"DXIR4" + sys.byteorder[0].encode() + b"\0\0"
+    header = struct.Struct("<8s20s8q")
     def __init__(self, path):
-        self.indexDir = os.path.dirname(path)
+        import mmap
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self.fingerprint, nstrings, nnodes, nattrs, ncomps, nblob, nsyms, nsymstrings, nsymblob = \
+                self.header.unpack_from(self.mmap)
+            if self.magic != magic:
+                raise ValueError("bad magic")
+            counts = [nstrings, nnodes, nattrs, ncomps, nblob, nsyms, nsymstrings, nsymblob]
+            if min(counts) < 0 or len(self.mmap) != self.header.size + \
+                4 * (5 * nnodes + 1 + 2 * nattrs + 2 * (ncomps + 1) + 8 * nsyms) + nblob + nsymblob:
+                raise ValueError("bad size")
+            # views of the map must all be released before it can be closed
+            view = memoryview(self.mmap)
+            self.views = [view]
+            offset = self.header.size
+            def arrays(count, length):
+                nonlocal offset
+                result = []
+                for _ in range(count):
+                    result.append(view[offset:offset + 4 * length].cast("i"))
+                    offset += 4 * length
+                self.views.extend(result)
+                return result
+            self.tags, self.texts, self.tails, self.parents = arrays(4, nnodes)
+            self.attrs, = arrays(1, nnodes + 1)
+            self.anames, self.avalues = arrays(2, nattrs)
+            cids, croots = arrays(2, ncomps + 1)
+            self.strings = [None] + str(view[offset:offset + nblob], "utf-8").split("\0")
+            offset += nblob
+            if len(self.strings) != nstrings:
+                raise ValueError("bad string table")
+            columns = [array.array("i", a) for a in arrays(8, nsyms)]
+            symstrings = str(view[offset:offset + nsymblob], "utf-8").split("\0") if nsymstrings else []
+            if len(symstrings) != nsymstrings:
+                raise ValueError("bad symbols string table")
+            self.symbols = symbols.__new__(symbols)
+            self.symbols.__setstate__([symstrings] + columns)
+            self.roots = {self.strings[cids[i]]: (croots[i], croots[i + 1]) for i in range(ncomps)}
+        except (struct.error, ValueError, TypeError, IndexError):
+            self.close()
+            raise ValueError("%s: invalid ir" % path)
+    def __contains__(self, id):
+        return id in self.roots
+    def compound(self, id):
+        lo, hi = self.roots.get(id, (None, None))
+        if lo is None:
+            raise FileNotFoundError("%s: compound not in ir" % id)
+        S = self.strings
+        tags, texts, tails = self.tags[lo:hi].tolist(), self.texts[lo:hi].tolist(), self.tails[lo:hi].tolist()
+        parents, attrs = self.parents[lo:hi].tolist(), self.attrs[lo:hi + 1].tolist()
+        anames, avalues = self.anames, self.avalues
+        nodes = []
+        for k in range(hi - lo):
+            a, b = attrs[k], attrs[k + 1]
+            n = node(S[tags[k]], {S[anames[j]]: S[avalues[j]] for j in range(a, b)} if a < b else {},
+                S[texts[k]], S[tails[k]])
+            if k:
+                nodes[parents[k] - lo].append(n)
+            nodes.append(n)
+        return nodes[0]
+    def close(self):
+        for view in getattr(self, "views", ()):
+            view.release()
+        self.views = []
+        self.mmap.close()
+    @staticmethod
+    def fingerprint_files(paths):
+        h = hashlib.sha1()
+        for path in paths:
+            try:
+                st = os.stat(path)
+                h.update(("%s\0%d\0%d\0" % (path, st.st_mtime_ns, st.st_size)).encode("utf-8"))
+            except EnvironmentError:
+                h.update(("%s\0-\0" % path).encode("utf-8"))
+        return h.digest()
+    @classmethod
+    def write(cls, path, fingerprint, compounds, symtab):
+        # compounds is an iterable of (id, root) pairs, where root is an
+        # ET.Element or node
+        strings = {None: 0}
+        def intern(s):
+            i = strings.get(s)
+            if i is None:
+                i = strings[s] = len(strings)
+            return i
+        tags, texts, tails, parents, attrs = (array.array("i") for _ in range(5))
+        anames, avalues, cids, croots = (array.array("i") for _ in range(4))
+        for id, root in compounds:
+            cids.append(intern(id))
+            croots.append(len(tags))
+            todo = [(root, -1)]
+            while todo:
+                e, parent = todo.pop()
+                i = len(tags)
+                tags.append(intern(e.tag))
+                texts.append(intern(e.text))
+                tails.append(intern(e.tail))
+                parents.append(parent)
+                attrs.append(len(anames))
+                for k, v in e.items():
+                    anames.append(intern(k))
+                    avalues.append(intern(v))
+                todo.extend((c, i) for c in reversed(list(e)))
+        cids.append(0)
+        croots.append(len(tags))
+        attrs.append(len(anames))
+        blob = "\0".join(list(strings)[1:]).encode("utf-8")
+        symstrings, *columns = symtab.__getstate__()
+        symblob = "\0".join(symstrings).encode("utf-8")
+        temppath = "%s.%d.tmp" % (path, os.getpid())
+        with open(temppath, "wb") as file:
+            file.write(cls.header.pack(cls.magic, fingerprint, len(strings), len(tags), len(anames),
+                len(cids) - 1, len(blob), len(symtab), len(symstrings), len(symblob)))
+            for a in [tags, texts, tails, parents, attrs, anames, avalues, cids, croots]:
+                a.tofile(file)
+            file.write(blob)
+            for a in columns:
+                a.tofile(file)
+            file.write(symblob)
+        os.replace(temppath, path)
+
+# Map fn over items on a pool of threads, at most window items ahead of the
+# consumer; results are yielded in order.
+def imap(fn, items, threads, window = None):
+    from concurrent.futures import ThreadPoolExecutor
+    items = list(items)
+    window = window or 2 * threads
+    with ThreadPoolExecutor(threads) as pool:
+        futures = collections.deque(pool.submit(fn, i) for i in items[:window])
+        for k in range(len(items)):
+            if k + window < len(items):
+                futures.append(pool.submit(fn, items[k + window]))
+            yield futures.popleft().result()
+
+# A parser may be given several index.xml files (e.g. from sharded doxygen runs),
+# which are read as a single index. Duplicate refids are recorded in collisions.
+#
+# Parsed compounds are kept in an LRU cache of at most cachesize entries (0 for
+# no limit); evicted compounds are parsed again when next needed.
+#
+# The cache and the symbols table may be used from several threads at once.
+#
+# The backend selects how compounds are read: "etree" parses the xml files with
+# ElementTree; "expat" parses them with expat into lightweight nodes; "ir"
+# compiles them once into an ir image (irname, next to the first index.xml) and
+# reads compounds from the image on later runs, as long as none of the xml files
+# has changed.
+class parser:
+    cachesize = 128
+    backend = "etree"
+    backends = ["etree", "expat", "ir"]
+    irname = "doxyfmt.ir"
+    def __init__(self, path, cachesize = None, backend = None):
+        self.path = path
+        self.cache = collections.OrderedDict()
+        self.lock = threading.RLock()
+        if cachesize is not None:
+            self.cachesize = cachesize
+        if backend is not None:
+            if backend not in self.backends:
+                raise ValueError("unknown backend: %s" % backend)
+            self.backend = backend
+        self.hits = self.misses = self.evictions = 0
+        self.parsetime = 0.0
+        self.local = threading.local()
+        self.symtab = None
+        self.image = None
+        self.load_index()
+    def load_index(self):
+        paths = [self.path] if isinstance(self.path, str) else list(self.path)
+        self.indexDir = os.path.dirname(paths[0])
         self.index = {}
-        with open(path) as file:
-            for e in ET.parse(file).findall("compound"):
-                self.index[e.get("refid")] = compound(self, element(e))
+        self.collisions = []
+        for path in paths:
+            dir = os.path.dirname(path)
+            for e in self.itercompounds(path):
+                id = e.get("refid")
+                if id in self.index:
+                    if "dir" != e.get("kind"):
+                        self.collisions.append((id, self.index[id].dir, dir))
+                    continue
+                self.index[id] = compound(self, element(e), dir)
+        if "ir" == self.backend:
+            # a changed tree is compiled from the xml, so the old image must not be read
+            if self.image is not None:
+                self.image.close()
+                self.image = None
+            self.image = self.load_ir(paths)
+            self.symtab = self.image.symbols if self.image is not None else None
+    # Re-read the index after the xml files have been regenerated. Cached
+    # compounds are kept if their xml is known to be unchanged (i.e. their
+    # digest was taken before); the symbols of the compounds that changed are
+    # dropped from the symbols table and scanned again. With the ir backend any
+    # change recompiles the whole image from the xml. Returns the ids of the
+    # added, removed and changed compounds.
+    def refresh(self):
+        with self.lock:
+            old = self.index
+            self.load_index()
+            changed = set(old).symmetric_difference(self.index)
+            for id, comp in self.index.items():
+                if id in old and (old[id].hash is None or old[id].hash != comp.digest()):
+                    changed.add(id)
+            for id in changed:
+                self.cache.pop(id, None)
+            if changed and self.image is None and self.symtab is not None:
+                symtab = self.symtab.without(changed, set(old).union(self.index))
+                self.scan_compounds(symtab, [id for id in self.index if id in changed])
+                self.symtab = symtab
+            return changed
+    def itercompounds(self, path):
+        # stream the index, keeping only each compound's attributes and name;
+        # member entries are cleared as soon as they have been read
+        root = None
+        for ev, e in ET.iterparse(path, events=("start", "end")):
+            if "start" == ev:
+                if root is None:
+                    root = e
+                continue
+            if "member" == e.tag:
+                e.clear()
+            elif "compound" == e.tag:
+                comp = ET.Element("compound", e.attrib)
+                ET.SubElement(comp, "name").text = e.findtext("name")
+                root.clear()
+                yield comp
+    def compound_path(self, id):
+        comp = self.index.get(id)
+        return os.path.join(comp.dir if comp else self.indexDir, id + ".xml")
+    def compound_element(self, id):
+        with self.lock:
+            elem = self.cache.get(id)
+            if elem is not None:
+                self.cache.move_to_end(id)
+                self.hits += 1
+                return elem
+            self.misses += 1
+        # parse outside the lock; if another thread got there first keep its element
+        t = time.perf_counter()
+        elem = self.parse_compound(id)
+        t = time.perf_counter() - t
+        self.local.parsetime = self.thread_parsetime() + t
+        self.local.misses = self.thread_misses() + 1
+        with self.lock:
+            self.parsetime += t
+            elem = self.cache.setdefault(id, elem)
+            self.cache.move_to_end(id)
+            if 0 < self.cachesize < len(self.cache):
+                self.cache.popitem(last=False)
+                self.evictions += 1
+        return elem
+    def thread_parsetime(self):
+        # time spent parsing compounds by the current thread
+        return getattr(self.local, "parsetime", 0.0)
+    def thread_misses(self):
+        # compounds parsed by the current thread
+        return getattr(self.local, "misses", 0)
+    def cache_stats(self):
+        return { "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "size": len(self.cache), "cachesize": self.cachesize }
     def parse_compound(self, id):
-        with open(os.path.join(self.indexDir, id + ".xml")) as file:
-            return element(ET.parse(file).find("compounddef[@id='" + id + "']"))
+        # compounds are returned with their innerclass moved into a sectiondef
+        # (see innerclass_section), so that rendering never modifies them
+        if self.image is not None:
+            return element(self.image.compound(id))
+        if "expat" == self.backend:
+            with open(self.compound_path(id), "rb") as file:
+                e = expat_parse(file).find("compounddef[@id='" + id + "']")
+        else:
+            with open(self.compound_path(id)) as file:
+                e = ET.parse(file).find("compounddef[@id='" + id + "']")
+        if e is not None:
+            innerclass_section(e)
+        return element(e)
+    # Parse compound id into the cache together with the compounds that its
+    # rendering refers to: its inner classes and the compounds that its
+    # typedefs alias (and theirs, up to depth).
+    def fetch(self, id, depth = 2):
+        try:
+            root = self.compound_element(id).XMLElement
+        except (EnvironmentError, ET.ParseError):
+            return
+        if 0 < depth:
+            for e in chain(root.iterfind("sectiondef/innerclass"),
+                root.iterfind("sectiondef/memberdef[@kind='typedef']/type/ref[@kindref='compound']")):
+                ref = e.get("refid")
+                if ref in self.index:
+                    self.fetch(ref, depth - 1)
+    # Iterate over ids while threads fetch the compounds of the next window ids
+    # in the background, so that reading and parsing them overlaps with the
+    # caller's work on the current one. The order of ids is kept; each id is
+    # yielded once its compounds are in the cache, which must be able to hold
+    # the compounds of window ids.
+    def prefetching(self, ids, threads, window = None):
+        ids = list(ids)
+        for id, _ in zip(ids, imap(self.fetch, ids, threads, window)):
+            yield id
+    def digest_compound(self, id):
+        with open(self.compound_path(id), "rb") as file:
+            return hashlib.sha1(file.read()).hexdigest()
+    def symbols(self, threads = 0):
+        # built on first use in a single pass over all compounds (parsed ahead
+        # on threads if any)
+        with self.lock:
+            if self.symtab is None:
+                symtab = symbols()
+                self.scan_compounds(symtab, list(self.index), threads)
+                self.symtab = symtab
+        return self.symtab
+    # The symbols table may be kept in a file between runs together with the
+    # digest of every compound; loading it rescans only the compounds whose
+    # digest changed (see refresh). A table that is already built is kept.
+    def load_symbols(self, path, threads = 0):
+        with self.lock:
+            if self.symtab is not None:
+                return self.symtab
+            try:
+                with open(path) as file:
+                    saved = json.load(file)
+                symtab = symbols.__new__(symbols)
+                symtab.__setstate__([saved["strings"]] +
+                    [array.array("i", c) for c in saved["columns"]])
+                digests = saved["digests"]
+            except (EnvironmentError, ValueError, KeyError, TypeError, IndexError):
+                return self.symbols(threads)
+            changed = set(digests).symmetric_difference(self.index)
+            for id, comp in self.index.items():
+                try:
+                    if id in digests and digests[id] != comp.digest():
+                        changed.add(id)
+                except EnvironmentError:
+                    changed.add(id)
+            if changed:
+                symtab = symtab.without(changed, set(digests).union(self.index))
+                self.scan_compounds(symtab, [id for id in self.index if id in changed], threads)
+            self.symtab = symtab
+            return symtab
+    def save_symbols(self, path):
+        if self.image is not None:
+            # the image carries the table
+            return
+        symtab = self.symbols()
+        digests = {}
+        for id, comp in self.index.items():
+            try:
+                digests[id] = comp.digest()
+            except EnvironmentError:
+                pass
+        strings, *columns = symtab.__getstate__()
+        temppath = "%s.%d.tmp" % (path, os.getpid())
+        with open(temppath, "w") as file:
+            json.dump({ "digests": digests, "strings": strings,
+                "columns": [c.tolist() for c in columns] }, file)
+        os.replace(temppath, path)
+    def scan_compounds(self, symtab, ids, threads = 0):
+        # the parsed compounds are kept in the cache while it has room
+        def parse(id):
+            try:
+                return self.cache.get(id) or self.parse_compound(id)
+            except (EnvironmentError, ET.ParseError):
+                return None
+        for id, elem in zip(ids, imap(parse, ids, threads) if 0 < threads else map(parse, ids)):
+            if elem is None:
+                continue
+            if id not in self.cache and (0 == self.cachesize or len(self.cache) < self.cachesize):
+                self.cache[id] = elem
+            self.scan_symbols(symtab, elem.XMLElement)
+    def scan_symbols(self, symtab, root):
+        for c in root.iter("compounddef"):
+            owner = c.get("id")
+            for e in c.iter("memberdef"):
+                alias = None
+                if "typedef" == e.get("kind"):
+                    r = e.find(".//ref[@kindref='compound']")
+                    if r is not None:
+                        alias = r.get("refid")
+                symtab.add(e.get("id"), e.get("kind"),
+                    "".join(chain.from_iterable(x.itertext() for x in e.findall("name"))),
+                    e.find("location"), owner, alias)
+            symtab.add(owner, c.get("kind"),
+                "".join(chain.from_iterable(x.itertext() for x in c.findall("compoundname"))),
+                c.find("location"), None)
+            for i in chain(c.iterfind("innerclass"), c.iterfind("sectiondef[@kind='innerclass']/innerclass")):
+                symtab.own(i.get("refid"), owner)
+    def load_ir(self, paths):
+        path = os.path.join(self.indexDir, self.irname)
+        fingerprint = ir.fingerprint_files(list(paths) + [self.compound_path(id) for id in self.index])
+        try:
+            image = ir(path)
+            if fingerprint == image.fingerprint:
+                return image
+            image.close()
+        except (EnvironmentError, ValueError):
+            pass
+        try:
+            self.compile_ir(path, fingerprint)
+            return ir(path)
+        except (EnvironmentError, ValueError):
+            # cannot write the image; fall back to parsing the xml
+            return None
+    def compile_ir(self, path, fingerprint):
+        symtab = symbols()
+        def compounds():
+            for id in self.index:
+                try:
+                    elem = self.parse_compound(id)
+                except (EnvironmentError, ET.ParseError):
+                    continue
+                if elem:
+                    self.scan_symbols(symtab, elem.XMLElement)
+                    yield id, elem.XMLElement
+        ir.write(path, fingerprint, compounds(), symtab)
+
+# A sink stands in for a template's module global output stream "_". Every
+# thread binds its own stream to it, so templates that write to a sink (and
+# declare it as their format's sink) can render from several threads at once.
+# The optimizing template translator reads _.write on entry to each function,
+# which picks up the stream of the current thread.
+class sink(threading.local):
+    stream = None
+    def bind(self, stream):
+        prev, self.stream = self.stream, stream
+        if stream is not None:
+            self.write = stream.write
+            self.flush = stream.flush
+        else:
+            # writes outside of a render fail rather than go to a finished stream
+            self.__dict__.pop("write", None)
+            self.__dict__.pop("flush", None)
+        return prev
+    def write(self, s):
+        raise ValueError("write to unbound sink")
+    def flush(self):
+        raise ValueError("flush of unbound sink")
 
 # Use ostream to squash multiple blank lines. Note that ostream
 # will *NOT* write the last line if it does not end in newline (\n).
 class ostream:
+    _blank_re = re.compile(r"^ +(?=\n)", re.MULTILINE)
+    _squash_re = re.compile(r"\n\n\n+")
+    _linesep_re = re.compile("[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
     def __init__(self, strm):
         self.__strm = strm
         self.__tail = ""
         self.__nlct = 0
+        self.bytes = 0
+        self.lines = 0
     def write(self, s):
+        self._writelines(s)
+    def flush(self):
+        pass
+    def _writelines(self, s):
         for l in s.splitlines(True):
             if self.__tail:
                 l = self.__tail + l
@@ -146,6 +1074,120 @@ class ostream:
                     continue
                 l = t
             self.__strm.write(l)
+            self.bytes += len(l.encode("utf-8"))
+            self.lines += 1
+    def _writeblock(self, s):
+        # squash a block that has no line boundaries other than \n
+        s = self.__tail + s
+        i = s.rfind("\n") + 1
+        self.__tail = s[i:]
+        if not i:
+            return
+        s = self._blank_re.sub("", s[:i])
+        n = len(s) - len(s.lstrip("\n"))
+        if len(s) == n:
+            s = "\n" * max(0, min(n, 2 - self.__nlct))
+            self.__nlct += n
+        else:
+            s = "\n" * max(0, min(n, 2 - self.__nlct)) + self._squash_re.sub("\n\n", s[n:])
+            self.__nlct = len(s) - len(s.rstrip("\n"))
+        if s:
+            self.__strm.write(s)
+            self.bytes += len(s.encode("utf-8"))
+            self.lines += s.count("\n")
+    def stats(self):
+        return { "bytes": self.bytes, "lines": self.lines }
+
+# A blockostream is an ostream that buffers writes and squashes them a block
+# at a time. It writes nothing until its buffer reaches blocksize or flush()
+# is called, so formats that use it must flush it (see format.flush). Blocks
+# that contain line boundaries other than \n (which str.splitlines also splits
+# on) are squashed a fragment and a line at a time as in ostream.
+class blockostream(ostream):
+    blocksize = 65536
+    def __init__(self, strm):
+        ostream.__init__(self, strm)
+        self.__buf = []
+        self.__buflen = 0
+    def write(self, s):
+        self.__buf.append(s)
+        self.__buflen += len(s)
+        if self.blocksize <= self.__buflen:
+            self.flush()
+    def flush(self):
+        if not self.__buf:
+            return
+        buf, s = self.__buf, "".join(self.__buf)
+        self.__buf = []
+        self.__buflen = 0
+        if self._linesep_re.search(s) is not None:
+            for s in buf:
+                self._writelines(s)
+        else:
+            self._writeblock(s)
+
+# A profile collects the wall time of the stages of a run and statistics of
+# every rendered file: total time, time spent parsing compounds, rendering and
+# writing, and counters (compounds parsed, element lookups, maptext calls and
+# bytes written). Sections are timed between begin and end; format times every
+# compounddef and memberdef (by kind, inclusive of nested sections) and
+# templates may time their own (see format.begin_section).
+class profile:
+    slowest = 10
+    counters = ["compounds", "lookups", "maptext", "bytes"]
+    def __init__(self):
+        self.stages = {}
+        self.files = []
+        self.totals = collections.Counter()
+        self.sections = collections.Counter()
+        self.current = collections.Counter()
+        self.__starts = []
+    def stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+    def start_file(self):
+        self.current = collections.Counter()
+        self.__starts = []
+    def begin(self, name):
+        self.__starts.append((name, time.perf_counter()))
+    def end(self, name):
+        n, t = self.__starts.pop()
+        if n != name:
+            raise ValueError("section %s ended while in %s" % (name, n))
+        self.current[n] += time.perf_counter() - t
+    def add_file(self, stats):
+        self.files.append(stats)
+        for k in ["time", "parse", "render", "write"] + self.counters:
+            self.totals[k] += stats[k]
+        self.sections.update(stats["sections"])
+    def json(self):
+        return { "stages": self.stages, "totals": dict(self.totals),
+            "sections": dict(self.sections),
+            "files": sorted(self.files, key=lambda f: -f["time"]) }
+    def report(self, file):
+        for k, v in self.stages.items():
+            print("profile: %-32s %8.3fs" % (k, v), file=file)
+        t = self.totals
+        if self.files:
+            print("profile: %d files: parse %.3fs, render %.3fs, write %.3fs" % (len(self.files),
+                t["parse"], t["render"], t["write"]), file=file)
+            print("profile: %d compounds parsed, %d element lookups, %d maptext calls, %d bytes written" %
+                (t["compounds"], t["lookups"], t["maptext"], t["bytes"]), file=file)
+        for k, v in self.sections.most_common():
+            print("profile: %-32s %8.3fs" % ("section " + k, v), file=file)
+        for f in sorted(self.files, key=lambda f: -f["time"])[:self.slowest]:
+            print("profile: %8.3fs (parse %.3fs, render %.3fs, write %.3fs) %s" % (f["time"],
+                f["parse"], f["render"], f["write"], f["file"]), file=file)
+
+# A shard specification "K/N" (1 <= K <= N) selects the K-th of N shards. File
+# compounds are assigned to shards by a hash of their refid, which is the same
+# in every process and on every platform.
+def shardspec(spec):
+    k, n = (int(i) for i in spec.split("/"))
+    if not 1 <= k <= n:
+        raise ValueError("invalid shard: %s" % spec)
+    return k, n
+def shard(refid, n):
+    return zlib.crc32(refid.encode("utf-8")) % n + 1
 
 class format:
     section_titles = {
@@ -229,6 +1271,7 @@ class format:
         "OBJECT-MACRO": "",
     }
     anon_re = re.compile(r"@[0-9]")
+    manifest = ".doxyfmt-manifest.json"
     summary_filter = description_filter = {
         "para": lambda e: (e.find("parameterlist") is None) and
             e.find("simplesect[@kind='copyright']") is None,
@@ -242,7 +1285,36 @@ class format:
         self.language = ""
         self.copytext = ""
         self.stack = []
-        self.__typedef_set = set()
+        self.__refid = None
+        self.__symbols = None
+        self.__deps = set()
+        self.escaper = escaper(self.escape_rules)
+        self.textmap = None
+        self.tailmap = None
+        self.__mappers = {}
+        self.__fragments = {}
+        self.fragment_hits = 0
+        self.fragment_misses = 0
+        self.maptext_calls = 0
+        prof = conf.get("profile")
+        self.profile = prof if isinstance(prof, profile) else profile() if prof else None
+
+    def compound(self, refid):
+        self.__deps.add(refid)
+        return self.index[refid].element()
+
+    def symbols(self):
+        if self.__symbols is None:
+            comp = next(iter(self.index.values()), None)
+            self.__symbols = comp.parser.symbols() if comp else symbols()
+        return self.__symbols
+    def folded(self, refid):
+        # is the compound folded into a typedef of the compound being rendered?
+        symtab = self.symbols()
+        for id in symtab.aliasedby.get(refid, ()):
+            if symtab.within(symtab.owner(id), self.__refid):
+                return True
+        return False
 
     def depth(self, tag):
         depth = 0
@@ -251,13 +1323,59 @@ class format:
                 depth += 1
         return depth
 
+    # output stream of the template (see sink); None if the template cannot
+    # render concurrently
+    sink = None
     def reset(self, file):
         pass
+    # called after rendering; formats whose stream buffers writes (see
+    # blockostream) must flush it here
+    def flush(self):
+        pass
 
+    # (pattern, replacement) rules applied by escape; see escaper
+    escape_rules = []
     def escape(self, text):
-        return text
+        return self.escaper(text)
+    # textmap and tailmap are compiled together with each filter on first use.
+    # Mapped text and the text of elements are cached for the duration of a
+    # render, so maps must produce the same text for an element every time.
     def maptext(self, elem, filter = None):
-        return elem.Maptext(self.escape, None, None, filter)
+        self.maptext_calls += 1
+        XMLElement = elem.XMLElement
+        key = (id(XMLElement), id(filter), id(self.textmap), id(self.tailmap))
+        f = self.__fragments.get(key)
+        if f is None:
+            m = self.__mappers.get(key[1:])
+            if m is None:
+                m = self.__mappers[key[1:]] = (mapper(self.escape, self.textmap, self.tailmap, filter),
+                    filter, self.textmap, self.tailmap)
+            f = self.__fragments[key] = (m[0](elem), XMLElement)
+            self.fragment_misses += 1
+        else:
+            self.fragment_hits += 1
+        return f[0]
+    def text(self, elem):
+        XMLElement = elem.XMLElement
+        key = (id(XMLElement), None)
+        f = self.__fragments.get(key)
+        if f is None:
+            f = self.__fragments[key] = (elem.T, XMLElement)
+            self.fragment_misses += 1
+        else:
+            self.fragment_hits += 1
+        return f[0]
+    # time a section of a template when profiling
+    def begin_section(self, name):
+        if self.profile is not None:
+            self.profile.begin(name)
+    def end_section(self, name):
+        if self.profile is not None:
+            self.profile.end(name)
+
+    def fragment_stats(self):
+        return { "hits": self.fragment_hits, "misses": self.fragment_misses,
+            "size": len(self.__fragments) }
 
     def heading(self, text, level):
         pass
@@ -285,11 +1403,11 @@ class format:
             self.heading(text, int(self.conf.get("heading", "1")) + self.depth("sectiondef"))
     def __summary(self, elem, elem2 = None):
         if None != elem2:
-            desc = ET.Element("description")
+            desc = (elem if elem else elem2).XMLElement.makeelement("description", {})
             desc.extend(elem.XMLElement.findall("para"))
             desc.extend(elem2.XMLElement.findall("para"))
             elem = element(desc)
-        if elem.T:
+        if self.text(elem):
             self.summary(elem)
     def __copyright(self, text):
         if text:
@@ -308,16 +1426,16 @@ class format:
         if text:
             self.syntax(text)
     def __parameters(self, elst):
-        if elst.T:
+        if self.text(elst):
             self.parameters(elst)
     def __returns(self, elem):
-        if elem.T:
+        if self.text(elem):
             self.returns(elem)
     def __enumvalues(self, elst):
         if elst:
             self.enumvalues(elst)
     def __description(self, elem):
-        if elem.T:
+        if self.text(elem):
             self.__parameters(elem[".//parameterlistE"])
             self.__returns(elem[".//simplesect[@kind='return']E"])
             if self.maptext(elem, self.description_filter).strip():
@@ -325,17 +1443,24 @@ class format:
     def __event(self, elem, ev):
         if "begin" == ev:
             self.stack.append(elem)
+            if self.profile is not None:
+                self.profile.begin(elem.N + ":" + elem.kindA)
             self.event(elem, ev)
         elif "end" == ev:
             self.event(elem, ev)
+            if self.profile is not None:
+                self.profile.end(elem.N + ":" + elem.kindA)
             self.stack.pop()
 
     def memberdef(self, elem):
         if elem.kindA in ["typedef"]:
-            e = elem[".//ref[@kindref='compound']E"]
-            if e:
-                self.__typedef_set.add(e.refidA)
-                self.compounddef(self.index[e.refidA].element(), elem.nameS, elem.definitionT)
+            symtab = self.symbols()
+            if elem.idA in symtab:
+                refid = symtab.alias(elem.idA)
+            else:
+                refid = elem[".//ref[@kindref='compound']E"].refidA
+            if refid:
+                self.compounddef(self.compound(refid), elem.nameS, elem.definitionT)
                 return
 
         self.__event(elem, "begin")
@@ -373,7 +1498,7 @@ class format:
     def sectiondef(self, elem):
         count = 0
         for e in elem.innerclassL:
-            if e.refidA not in self.__typedef_set:
+            if not self.folded(e.refidA):
                 count += 1
         for e in elem.memberdefL:
             count += 1
@@ -388,17 +1513,19 @@ class format:
         self.__summary(elem.descriptionE)
         contents = []
         for e in elem.innerclassL:
-            if e.refidA not in self.__typedef_set:
-                contents.append(self.index[e.refidA].element())
+            if not self.folded(e.refidA):
+                contents.append(self.compound(e.refidA))
         for e in elem.memberdefL:
             contents.append(e)
         order = self.conf.get("order", "source")
         if "doxygen" == order:
             pass
         elif "alpha" == order:
-            contents.sort(key = lambda e: e.compoundnameS or e.nameS)
+            symtab = self.symbols()
+            contents.sort(key = lambda e: symtab.name(e.idA) or e.compoundnameS or e.nameS)
         else: # "source"
-            contents.sort(key = lambda e: "%s:%10s:%10s" %
+            symtab = self.symbols()
+            contents.sort(key = lambda e: symtab.sortkey(e.idA) or "%s:%10s:%10s" %
                 (e.locationE.fileA, e.locationE.lineA, e.locationE.columnA))
         for e in contents:
             if "compounddef" == e.N:
@@ -408,15 +1535,9 @@ class format:
         self.__event(elem, "end")
 
     def compounddef(self, elem, override_name=None, override_definition=None):
-        # massage compounddef so that innerclass appears inside sectiondef
-        e = elem.XMLElement
-        incl = e.findall("innerclass")
-        if incl:
-            for i in incl:
-                e.remove(i)
-            sect = ET.Element("sectiondef", { "kind": "innerclass" })
-            sect.extend(incl)
-            e.append(sect)
+        # compounds from the parser already have their innerclass in a sectiondef
+        if innerclass_section(elem.XMLElement):
+            elem.invalidate()
 
         self.__event(elem, "begin")
         if elem.kindA in ["file"]:
@@ -441,17 +1562,224 @@ class format:
             raise NotImplementedError(elem.kindA)
         self.__event(elem, "end")
 
+    # Render the file compound refid to ofile (any object with a write method)
+    # and return the name of its output file. A format renders one compound at
+    # a time; use a renderer to render from several threads or to nest renders.
+    def render_stream(self, refid, ofile):
+        self.__refid = refid
+        self.__deps = set()
+        self.__fragments = {}
+        self.stack = []
+        comp = self.compound(refid)
+        self.language = comp.languageA
+        self.copytext = comp[".//simplesect[@kind='copyright']E"]["T"]
+        file = comp.locationE.fileA
+        if not file:
+            file = comp.compoundnameS
+        file = file.replace("_", "__").replace(":", "").replace("/", "_").replace("\\", "_")
+        file += self.fileext
+        prev = self.sink.stream if self.sink is not None else None
+        try:
+            self.reset(ofile)
+            self.compounddef(comp)
+            self.flush()
+        finally:
+            if self.sink is not None:
+                self.sink.bind(prev)
+        return file
+    def render_string(self, refid):
+        ofile = io.StringIO()
+        self.render_stream(refid, ofile)
+        return ofile.getvalue()
+
+    def render(self, refid):
+        prof = self.profile
+        if prof is not None:
+            parser = self.index[refid].parser
+            parse, misses, nlookups = parser.thread_parsetime(), parser.thread_misses(), lookups
+            maps = self.maptext_calls
+            prof.start_file()
+            t0 = time.perf_counter()
+        ofile = io.StringIO()
+        file = self.render_stream(refid, ofile)
+        if prof is not None:
+            t1 = time.perf_counter()
+        # leave identical output untouched so that its mtime is preserved
+        path = os.path.join(self.outdir, file)
+        text = ofile.getvalue()
+        try:
+            with open(path, newline="") as ifile:
+                same = text == ifile.read()
+        except EnvironmentError:
+            same = False
+        if not same:
+            with open(path, "w", newline="\n") as ofile:
+                ofile.write(text)
+        deps = {i: self.index[i].digest() for i in sorted(self.__deps)}
+        if prof is not None:
+            t2 = time.perf_counter()
+            parse = parser.thread_parsetime() - parse
+            prof.add_file({ "refid": refid, "file": file, "time": t2 - t0, "parse": parse,
+                "render": t1 - t0 - parse, "write": t2 - t1, "compounds": parser.thread_misses() - misses,
+                "lookups": lookups - nlookups,
+                "maptext": self.maptext_calls - maps,
+                "bytes": len(text.encode("utf-8")), "sections": dict(prof.current) })
+        return file, deps
+
+    def stamp(self):
+        # changes to the template, doxylib or the configuration invalidate the
+        # manifest; the template and doxylib are hashed as they were loaded, so
+        # that edits made while watching do not stamp output of the old code
+        h = hashlib.sha1()
+        h.update((self.conf.get("template_digest") or source_digest(self.conf["template"])).encode())
+        h.update(source_digest(__file__).encode())
+        conf = {k: v for k, v in self.conf.items()
+            if k not in ["jobs", "template", "template_digest", "backend", "interval", "shard",
+                "profile", "prefetch"]}
+        h.update(json.dumps(conf, sort_keys=True, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    def uptodate(self, entry):
+        if not os.path.isfile(os.path.join(self.outdir, entry["file"])):
+            return False
+        for i, h in entry["deps"].items():
+            if i not in self.index or h != self.index[i].digest():
+                return False
+        return True
+
     def main(self):
-        for i in self.index:
-            comp = self.index[i].element()
-            if "file" != comp.kindA:
-                continue
-            self.language = comp.languageA
-            self.copytext = comp[".//simplesect[@kind='copyright']E"]["T"]
-            file = comp.locationE.fileA
-            if not file:
-                file = elem.compoundnameS
-            file = file.replace("_", "__").replace(":", "").replace("/", "_").replace("\\", "_")
-            with open(os.path.join(self.outdir, file + self.fileext), "w", newline="\n") as ofile:
-                self.reset(ofile)
-                self.compounddef(comp)
+        files = [i for i in self.index if "file" == self.index[i].cref.kindA]
+        manifest = self.manifest
+        if self.conf.get("shard"):
+            # render only the files of one shard; each shard keeps its own manifest
+            k, n = shardspec(self.conf["shard"])
+            files = [i for i in files if k == shard(i, n)]
+            if manifest:
+                base, ext = os.path.splitext(manifest)
+                manifest = "%s.%d-%d%s" % (base, k, n, ext)
+        mpath = None
+        entries = {}
+        if manifest and "template" in self.conf:
+            mpath = os.path.join(self.outdir, manifest)
+            stamp = self.stamp()
+            try:
+                with open(mpath) as file:
+                    manifest = json.load(file)
+                if stamp == manifest["stamp"]:
+                    ids = set(files)
+                    entries = {i: e for i, e in manifest["files"].items()
+                        if i in ids and self.uptodate(e)}
+            except (EnvironmentError, ValueError, KeyError):
+                pass
+        todo = [i for i in files if i not in entries]
+        spath = None
+        if mpath and todo:
+            # the symbols table is kept next to the manifest, so that a rerun
+            # rescans only the compounds whose xml changed
+            spath = os.path.splitext(mpath)[0] + ".symbols.json"
+        jobs = int(self.conf.get("jobs", 1))
+        prefetch = int(self.conf.get("prefetch", 0))
+        if not (1 < jobs and "template" in self.conf) and 1 < len(todo):
+            # the prefetch threads also parse ahead for the symbols table
+            threads = max(0, prefetch)
+        else:
+            threads = 0
+        if todo and (spath or self.profile is not None):
+            t = time.perf_counter()
+            parser = self.index[todo[0]].parser
+            if spath:
+                parser.load_symbols(spath, threads)
+            else:
+                parser.symbols(threads)
+            if self.profile is not None:
+                self.profile.stage("symbols", time.perf_counter() - t)
+        if 1 < jobs and 1 < len(todo) and "template" in self.conf:
+            # each worker loads its own template and parser; results come back in index order
+            from concurrent.futures import ProcessPoolExecutor
+            initargs = (self.conf["template"], type(self).__name__,
+                self.index[todo[0]].parser.path, self.conf, self.symbols())
+            with ProcessPoolExecutor(jobs, initializer=_render_init, initargs=initargs) as pool:
+                results = list(pool.map(_render_file, todo,
+                    chunksize=max(1, len(todo) // (jobs * 4))))
+        else:
+            ids = todo
+            if 0 < threads:
+                # build the symbols table first; its scan would hold up the prefetch threads
+                parser = self.index[todo[0]].parser
+                parser.symbols(threads)
+                ids = parser.prefetching(todo, threads)
+                if self.profile is not None:
+                    parse, own = parser.parsetime, parser.thread_parsetime()
+                    misses, ownmisses = parser.misses, parser.thread_misses()
+            results = [self.render(i) for i in ids]
+            if 0 < threads and self.profile is not None:
+                # compounds parsed on the prefetch threads are not charged to any file
+                self.profile.stage("prefetch parse (threads)",
+                    parser.parsetime - parse - (parser.thread_parsetime() - own))
+                self.profile.totals["compounds"] += parser.misses - misses - \
+                    (parser.thread_misses() - ownmisses)
+        for i, result in zip(todo, results):
+            entries[i] = { "file": result[0], "deps": result[1] }
+            if 2 < len(result):
+                # profile of a file rendered by a worker process
+                self.profile.add_file(result[2])
+        if spath:
+            try:
+                self.index[todo[0]].parser.save_symbols(spath)
+            except EnvironmentError:
+                pass
+        if mpath:
+            with open(mpath + ".tmp", "w") as file:
+                json.dump({ "stamp": stamp, "files": entries }, file, indent=1, sort_keys=True)
+            os.replace(mpath + ".tmp", mpath)
+        return [os.path.join(self.outdir, entries[i]["file"]) for i in files]
+
+# The sha1 of a source file the first time it is asked for in this process.
+@functools.lru_cache(maxsize=None)
+def source_digest(path):
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+# A renderer renders file compounds to strings from any number of threads over
+# one shared parser. Formats keep state while rendering, so every render borrows
+# an idle instance of the format class (creating one when there is none); this
+# also allows a render to start another from within. The format must declare
+# its sink.
+class renderer:
+    def __init__(self, cls, conf, index):
+        if cls.sink is None:
+            raise ValueError("%s does not support concurrent rendering" % cls.__name__)
+        self.cls = cls
+        self.conf = dict(conf)
+        self.conf.setdefault("outdir", ".")
+        self.conf.setdefault("fileext", "")
+        self.index = index
+        self.__idle = []
+        self.__lock = threading.Lock()
+    def render_stream(self, refid, ofile):
+        with self.__lock:
+            fmt = self.__idle.pop() if self.__idle else None
+        if fmt is None:
+            fmt = self.cls(self.conf, self.index)
+        try:
+            return fmt.render_stream(refid, ofile)
+        finally:
+            with self.__lock:
+                self.__idle.append(fmt)
+    def render_string(self, refid):
+        ofile = io.StringIO()
+        self.render_stream(refid, ofile)
+        return ofile.getvalue()
+
+def _render_init(template, name, path, conf, symtab = None):
+    global _render_format
+    import pytempl
+    p = parser(path, int(conf.get("cachesize", parser.cachesize)), conf.get("backend"))
+    if p.symtab is None:
+        p.symtab = symtab
+    _render_format = getattr(pytempl.template_load(template), name)(conf, p.index)
+def _render_file(refid):
+    result = _render_format.render(refid)
+    if _render_format.profile is not None:
+        return result + (_render_format.profile.files.pop(),)
+    return result
@@ -48,73 +48,232 @@
 #     : </div>
 #     : </summary>
 #
+# A template that contains the line *#pytempl: optimize* is translated by
+# an optimizing code generator: consecutive *:* lines are merged into a
+# single write and the output stream is bound to locals on function entry.
+# Such templates must not rebind *_* from within *${}* expressions.
+#
 # COPYRIGHT
 # ---------
 # (C) 2014-2020 Bill Zissimopoulos
 
-import os, re, sys, types
+import hashlib, marshal, os, re, struct, sys, types
+from importlib.util import MAGIC_NUMBER, cache_from_source, spec_from_file_location
 
 # begin template engine
 template_copy_re = re.compile(r"^(\s*): ?(.*)", re.DOTALL)
 template_expr_re = re.compile(r"\$\{([^}]+)\}")
 template_copy_stmt = ("_.write(%r)", "_.write(_str(%s))")
-def template_translate(source):
+template_copy_part = ("%r", "_str(%s)")
+template_optimize_re = re.compile(r"^#[ \t]*pytempl:[ \t]*optimize[ \t]*$", re.MULTILINE)
+def template_translate(source, optimize=False):
     for line in source:
         m = template_copy_re.search(line)
         if m:
-            line = m.group(1) + ";".join(template_copy_stmt[i % 2] % p
-                for i, p in enumerate(template_expr_re.split(m.group(2))) if p) + "\n"
+            if optimize:
+                # a copy line with nothing to write (only the last line of a
+                # file, which has no newline) becomes pass
+                parts = [template_copy_part[i % 2] % p
+                    for i, p in enumerate(template_expr_re.split(m.group(2))) if p]
+                line = m.group(1) + ("_.write(" + " + ".join(parts) + ")" if parts else "pass") + "\n"
+            else:
+                line = m.group(1) + ";".join(template_copy_stmt[i % 2] % p
+                    for i, p in enumerate(template_expr_re.split(m.group(2))) if p) + "\n"
         yield line
-def template_compile(source, fullpath, dict):
-    exec(compile("".join(template_translate(source)), fullpath, "exec"), dict)
-def template_load(fullpath, _=None):
+def template_compile(source, fullpath, dict, optimize=False):
+    source = "".join(template_translate(source, optimize))
+    if optimize:
+        source = template_optimize(source, fullpath)
+    exec(compile(source, fullpath, "exec"), dict)
+
+# The optimizer works on the AST of the translated template, so line numbers
+# are preserved. It merges consecutive _.write() statements into a single write
+# and binds _.write and _str to locals on entry to each function that writes
+# (unless the function rebinds _). Because of this, ${} expressions in
+# optimized templates must not write to _ themselves.
+def template_optimize(source, fullpath):
+    import ast
+    def iswrite(node):
+        return isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+            "write" == node.func.attr and isinstance(node.func.value, ast.Name) and \
+            "_" == node.func.value.id and 1 == len(node.args) and not node.keywords
+    def parts(node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            l, r = parts(node.left), parts(node.right)
+            if l is not None and r is not None:
+                return l + r
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) or \
+            isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and "_str" == node.func.id:
+            return [node]
+        return None
+    def concat(nodes):
+        result = []
+        for node in nodes:
+            if result and isinstance(node, ast.Constant) and isinstance(result[-1], ast.Constant):
+                result[-1] = ast.copy_location(
+                    ast.Constant(result[-1].value + node.value), result[-1])
+            else:
+                result.append(node)
+        if 4 < len(result):
+            return ast.copy_location(ast.Call(
+                ast.Attribute(ast.Constant(""), "join", ast.Load()),
+                [ast.Tuple(result, ast.Load())], []), result[0])
+        expr = result[0]
+        for node in result[1:]:
+            expr = ast.copy_location(ast.BinOp(expr, ast.Add(), node), expr)
+        return expr
+    def merge(body):
+        result = []
+        groups = []
+        for stmt in body:
+            if isinstance(stmt, ast.Expr) and iswrite(stmt.value):
+                p = parts(stmt.value.args[0]) or [stmt.value.args[0]]
+                if result and groups and result[-1] is groups[-1][0]:
+                    groups[-1][1].extend(p)
+                    continue
+                groups.append((stmt, p))
+            result.append(stmt)
+        for stmt, p in groups:
+            stmt.value.args[0] = concat(p)
+        return result
+    def scope(func):
+        # nodes of func's own scope, excluding nested functions and classes
+        todo = list(ast.iter_child_nodes(func))
+        while todo:
+            node = todo.pop()
+            yield node
+            if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+                todo.extend(ast.iter_child_nodes(node))
+    tree = ast.parse(source, fullpath)
+    for node in ast.walk(tree):
+        for field in ["body", "orelse", "finalbody"]:
+            body = getattr(node, field, None)
+            if isinstance(body, list) and body and isinstance(body[0], ast.stmt):
+                setattr(node, field, merge(body))
+    for func in ast.walk(tree):
+        if not isinstance(func, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        nodes = list(scope(func))
+        if any(isinstance(n, (ast.Global, ast.Nonlocal)) and ("_" in n.names or "_str" in n.names) or
+            isinstance(n, ast.Name) and n.id in ["_", "_str"] and not isinstance(n.ctx, ast.Load) or
+            isinstance(n, ast.arg) and n.arg in ["_", "_str"]
+            for n in nodes):
+            continue
+        writes = [n for n in nodes if iswrite(n)]
+        strs = [n for n in nodes if isinstance(n, ast.Name) and "_str" == n.id]
+        if not writes:
+            continue
+        for n in writes:
+            n.func = ast.copy_location(ast.Name("_pytempl_write", ast.Load()), n.func)
+        for n in strs:
+            n.id = "_pytempl_str"
+        first = 1 if isinstance(func.body[0], ast.Expr) and \
+            isinstance(func.body[0].value, ast.Constant) and 1 < len(func.body) else 0
+        binds = [ast.parse("_pytempl_write = _.write").body[0]]
+        if strs:
+            binds.append(ast.parse("_pytempl_str = _str").body[0])
+        for b in binds:
+            for n in ast.walk(b):
+                ast.copy_location(n, func.body[first])
+        func.body[first:first] = binds
+    return ast.fix_missing_locations(tree)
+
+# template code cache; compiled templates are marshalled where the bytecode of
+# a module next to the template would go (__pycache__ or sys.pycache_prefix)
+# and reused while the template's mtime and size match. As with bytecode, the
+# cache is not written when sys.dont_write_bytecode is set.
+template_cache = True
+template_cache_magic = MAGIC_NUMBER + b"pyt2"
+def template_cache_path(fullpath):
+    return os.path.splitext(cache_from_source(fullpath, optimization=""))[0] + ".pytc"
+def template_code(fullpath, optimize=None):
+    st = os.stat(fullpath)
+    header = template_cache_magic + struct.pack("<qqb", st.st_mtime_ns, st.st_size,
+        -1 if optimize is None else int(optimize))
+    cachepath = template_cache_path(fullpath)
+    if template_cache:
+        try:
+            with open(cachepath, "rb") as file:
+                data = file.read()
+            if data[:len(header)] == header:
+                return marshal.loads(data[len(header):])
+        except (EnvironmentError, EOFError, ValueError, TypeError):
+            pass
+    with open(fullpath) as file:
+        source = file.read()
+    if optimize is None:
+        optimize = template_optimize_re.search(source) is not None
+    source = "".join(template_translate(source.splitlines(True), optimize))
+    if optimize:
+        source = template_optimize(source, fullpath)
+    code = compile(source, fullpath, "exec")
+    if template_cache and not sys.dont_write_bytecode:
+        try:
+            os.makedirs(os.path.dirname(cachepath), exist_ok=True)
+            temppath = "%s.%d.tmp" % (cachepath, os.getpid())
+            with open(temppath, "wb") as file:
+                file.write(header + marshal.dumps(code))
+            os.replace(temppath, cachepath)
+        except EnvironmentError:
+            pass
+    return code
+# The sha1 of the template source as it was loaded is kept in the module's
+# _pytempl_digest.
+def template_digest(fullpath):
+    with open(fullpath, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest()
+def template_load(fullpath, _=None, optimize=None):
     n = os.path.splitext(os.path.basename(fullpath))[0]
     m = types.ModuleType(n)
     m.__file__ = fullpath
+    m._pytempl_digest = template_digest(fullpath)
     m.__loader__ = None
     m.__package__ = ""
     m._str = str
     m._ = sys.stdout if _ is None else _
-    with open(fullpath) as source:
-        template_compile(source, fullpath, m.__dict__)
+    exec(template_code(fullpath, optimize), m.__dict__)
     return m
 # end template engine -- seriously!
 
 # pytempl import hook; allows importing .pyt files directly
+#
+# The finder lists each directory on the search path once and keeps the names
+# of the templates in it, so that imports of other modules cost a set lookup
+# per path entry rather than a stat. Templates added to a directory that has
+# already been listed are found after importlib.invalidate_caches().
 class finder:
-    def find_module(self, fullname, pathlist=None):
-        if pathlist is None:
-            filepath = os.path.join(*fullname.split(".")) + ".pyt"
-            pathlist = sys.path
-        else:
-            filepath = os.path.join(*fullname.split(".")[1:]) + ".pyt"
-        for fullpath in pathlist:
-            fullpath = os.path.join(fullpath, filepath)
-            if os.path.isfile(fullpath):
-                return loader(fullpath)
+    def __init__(self):
+        self.listings = {}
+    def listing(self, dir):
+        names = self.listings.get(dir)
+        if names is None:
+            try:
+                names = frozenset(n for n in os.listdir(dir or ".") if n.endswith(".pyt"))
+            except (EnvironmentError, TypeError, ValueError):
+                names = frozenset()
+            self.listings[dir] = names
+        return names
+    def find_spec(self, fullname, pathlist=None, target=None):
+        filename = fullname.rpartition(".")[2] + ".pyt"
+        for dir in sys.path if pathlist is None else pathlist:
+            if filename in self.listing(dir):
+                fullpath = os.path.join(dir, filename)
+                return spec_from_file_location(fullname, fullpath, loader=loader(fullpath))
         return None
+    def invalidate_caches(self):
+        self.listings.clear()
     def __pytempl__(self):
         pass
 class loader:
     def __init__(self, fullpath):
         self.fullpath = fullpath
-    def load_module(self, fullname):
-        m = oldm = sys.modules.get(fullname)
-        if m is None:
-            m = sys.modules[fullname] = types.ModuleType(fullname)
-        m.__file__ = self.fullpath
-        m.__loader__ = self
-        m.__package__ = fullname.rpartition('.')[0]
+    def create_module(self, spec):
+        return None
+    def exec_module(self, m):
+        m._pytempl_digest = template_digest(self.fullpath)
         m._str = str
         m._ = sys.stdout
-        try:
-            with open(self.fullpath) as source:
-                template_compile(source, self.fullpath, m.__dict__)
-            return m
-        except:
-            if oldm is None:
-                del sys.modules[fullname]
-            raise
+        exec(template_code(self.fullpath), m.__dict__)
 sys.meta_path = [f for f in sys.meta_path if not hasattr(f, "__pytempl__")]
 sys.meta_path.append(finder())
 